@@ -0,0 +1,39 @@
+from contextlib import contextmanager
+from pathlib import Path
+import os
+
+# Files are written under a temporary name and renamed into place once complete, so that readers (and a later run
+# after a crash) only ever see the previous contents or the new ones, never a partly written file.
+
+
+def tmp_path(path, unique=False):
+    """
+    The temporary name `path` is written under. With `unique` set it includes the process id, for files that several
+    processes may write at once.
+    """
+    path = Path(path)
+    return path.with_name(f"{path.name}.{os.getpid()}.tmp" if unique else f"{path.name}.tmp")
+
+
+@contextmanager
+def atomic_path(path, unique=False):
+    """
+    Gives the temporary path to write `path` through, and renames it into place when the block exits normally. If the
+    block raises, the temporary file is removed instead.
+    """
+    tmp = tmp_path(path, unique)
+    try:
+        yield tmp
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, path)
+
+
+@contextmanager
+def atomic_open(path, mode="w", unique=False):
+    """
+    `open(path, mode)` through `atomic_path`: the file is only renamed into place once it is closed.
+    """
+    with atomic_path(path, unique) as tmp, open(tmp, mode) as file:
+        yield file
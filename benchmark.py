@@ -0,0 +1,445 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from pathlib import Path
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from config import the_config
+
+N_BINS = 1024
+
+
+def _pulse_gaussian(t, width):
+    return np.exp(-0.5 * (t / width)**2)
+
+
+def _pulse_exponential(t, width):
+    # Fast rise over a fifth of `width`, then an exponential decay with time constant `width`
+    rise = width / 5
+    return np.where(t < 0, np.exp(-0.5 * (t / rise)**2), np.exp(-np.maximum(t, 0) / width))
+
+
+def _pulse_none(t, width):
+    return np.zeros_like(t)
+
+
+PULSE_SHAPES = {
+    "gaussian": _pulse_gaussian,
+    "exponential": _pulse_exponential,
+    "none": _pulse_none,
+}
+
+
+def write_dat_file(path, n_events, board=2914, channels=(1, 2, 3, 4), pulse_shape="exponential",
+                   amplitude=(0.01, 0.3), width=(1.0, 10.0), noise=0.002, polarity=-1, range_center=0,
+                   trigger_rate=100.0, start=datetime(2022, 3, 27, 12), seed=0, block_size=10_000):
+    """
+    Writes a synthetic DRS4 binary file (DRS2/TIME header followed by EHDR event records) that `DRSDatFile` reads
+    like one from the lab. Every event carries one pulse per channel, with an amplitude (V) and width (ns) drawn
+    uniformly from `amplitude` and `width`, a random position in the middle of the window and gaussian noise of
+    `noise` V. Events arrive as a Poisson process of `trigger_rate` Hz from `start`, and are generated `block_size`
+    at a time so files of any size can be written.
+
+    The reader expects each event record to hold a single board, so one file covers one `board`.
+    """
+    rng = np.random.default_rng(seed)
+    shape = PULSE_SHAPES[pulse_shape]
+    channel_dtype = np.dtype([
+        ("channel_tag", "S1"),
+        ("channel", "S3"),
+        ("scaler", "<u4"),
+        ("waveform", "<u2", (N_BINS,)),
+    ])
+    record_dtype = np.dtype([
+        ("ehdr", "S4"),
+        ("serial_number", "<u4"),
+        ("year", "<u2"),
+        ("month", "<u2"),
+        ("day", "<u2"),
+        ("hour", "<u2"),
+        ("minute", "<u2"),
+        ("second", "<u2"),
+        ("millisecond", "<u2"),
+        ("range_center", "<u2"),
+        ("board_tag", "S2"),
+        ("board", "<u2"),
+        ("trigger_tag", "S2"),
+        ("trigger_cell", "<u2"),
+        ("channels", channel_dtype, (len(channels),)),
+    ])
+
+    bin_widths = {channel: rng.uniform(0.18, 0.22, N_BINS).astype("<f4") for channel in channels}
+    times = {channel: np.cumsum(bin_widths[channel]).astype(np.float64) for channel in channels}
+    arrival = np.datetime64(start, "ms")
+    with open(path, "wb") as file:
+        file.write(b"DRS2TIME")
+        file.write(b"B#" + np.array(board, dtype="<u2").tobytes())
+        for channel in channels:
+            file.write(b"C%03d" % channel + bin_widths[channel].tobytes())
+
+        for block_start in range(0, n_events, block_size):
+            n_block = min(block_size, n_events - block_start)
+            records = np.zeros(n_block, dtype=record_dtype)
+            records["ehdr"] = b"EHDR"
+            records["serial_number"] = np.arange(block_start, block_start + n_block) + 1
+
+            gaps = rng.exponential(1000.0 / trigger_rate, n_block).astype(np.int64)
+            stamps = arrival + np.cumsum(gaps).astype("m8[ms]")
+            arrival = stamps[-1]
+            days = stamps.astype("M8[D]")
+            months = stamps.astype("M8[M]")
+            ms_of_day = (stamps - days).astype(np.int64)
+            records["year"] = stamps.astype("M8[Y]").astype(np.int64) + 1970
+            records["month"] = months.astype(np.int64) % 12 + 1
+            records["day"] = (days - months).astype(np.int64) + 1
+            records["hour"] = ms_of_day // 3_600_000
+            records["minute"] = ms_of_day // 60_000 % 60
+            records["second"] = ms_of_day // 1000 % 60
+            records["millisecond"] = ms_of_day % 1000
+            records["range_center"] = range_center
+            records["board_tag"] = b"B#"
+            records["board"] = board
+            records["trigger_tag"] = b"T#"
+            records["trigger_cell"] = rng.integers(0, N_BINS, n_block)
+
+            for channel_idx, channel in enumerate(channels):
+                t = times[channel]
+                peak_t = rng.uniform(0.2 * t[-1], 0.8 * t[-1], n_block)[:, None]
+                pulse = shape(t - peak_t, rng.uniform(*width, n_block)[:, None])
+                volts = polarity * rng.uniform(*amplitude, n_block)[:, None] * pulse
+                volts += rng.normal(0.0, noise, (n_block, N_BINS))
+                adc = (volts - range_center / 1000.0 + 0.5) * 65535.0
+                block = records["channels"][:, channel_idx]
+                block["channel_tag"] = b"C"
+                block["channel"] = b"%03d" % channel
+                block["scaler"] = rng.poisson(trigger_rate, n_block)
+                block["waveform"] = np.clip(np.rint(adc), 0, 65535)
+            file.write(records.tobytes())
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    n_events: int
+    seconds: float
+    peak_bytes: int
+
+    @property
+    def events_per_second(self):
+        return self.n_events / self.seconds if self.seconds else float("inf")
+
+
+def measure(name, n_events, fn):
+    """
+    Runs `fn` once, recording its wall time and the peak memory it allocated (as seen by tracemalloc, which also
+    tracks NumPy arrays). Returns (BenchmarkResult, return value of `fn`).
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        value = fn()
+        seconds = time.perf_counter() - start
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return BenchmarkResult(name, n_events, seconds, peak_bytes), value
+
+
+@contextmanager
+def config_override(**values):
+    """
+    Temporarily sets fields of `the_config`.
+    """
+    saved = {name: getattr(the_config, name) for name in values}
+    for name, value in values.items():
+        setattr(the_config, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(the_config, name, value)
+
+
+def bench_file(dat_file_path, work_dir, n_events):
+    """
+    The stages of converting one file: `_parse`, `_process` and `to_root` on a fully loaded file, and the streaming
+    `convert` that `process_all` uses.
+    """
+    from process import DRSDatFile
+
+    def parse():
+        drs = DRSDatFile(dat_file_path, load=False, verbose=False)
+        drs._parse()
+        return drs
+
+    results = []
+    result, drs = measure("parse", n_events, parse)
+    results.append(result)
+    results.append(measure("process", n_events, drs._process)[0])
+    results.append(measure("to_root", n_events, lambda: drs.to_root(Path(work_dir) / "to_root.root"))[0])
+    del drs
+
+    drs = DRSDatFile(dat_file_path, load=False, verbose=False)
+    results.append(measure("convert", n_events, lambda: drs.convert(Path(work_dir) / "convert.root"))[0])
+    return results
+
+
+def available_backends():
+    """
+    The feature backends whose dependencies are installed.
+    """
+    from features import FEATURE_BACKENDS, pulse_bounds_backend
+    backends = []
+    for backend in FEATURE_BACKENDS:
+        try:
+            pulse_bounds_backend(backend)
+        except ImportError:
+            continue
+        backends.append(backend)
+    return backends
+
+
+def _loaded_tables(dat_file_path):
+    from process import DRSDatFile
+    drs = DRSDatFile(dat_file_path, load=False, verbose=False)
+    drs._parse()
+    return drs._events, drs.EDGE_PEAK_KEEP_OUT
+
+
+def bench_feature_backends(dat_file_path, n_events):
+    """
+    `extract_features` on every channel of a file with each available backend. Compiled backends are run once on a
+    few events first so compilation isn't timed.
+    """
+    from features import extract_features
+    tables, edge_keep_out = _loaded_tables(dat_file_path)
+    results = []
+    for backend in available_backends():
+        for table in tables.values():
+            extract_features(table.waveform[:10].copy(), table.times, edge_keep_out, backend=backend)
+
+        def run_backend():
+            for table in tables.values():
+                extract_features(table.waveform.copy(), table.times, edge_keep_out, backend=backend)
+        results.append(measure(f"features ({backend})", n_events, run_backend)[0])
+    return results
+
+
+def check_feature_backends(dat_file_path, rtol=1e-9, atol=1e-12):
+    """
+    Compares the features found by each available backend with the "numpy" reference on every event of a file.
+    Returns (backend, (board, channel), feature, number of events outside tolerance) for each feature that differs.
+    """
+    from features import extract_features
+    tables, edge_keep_out = _loaded_tables(dat_file_path)
+    mismatches = []
+    for channel, table in tables.items():
+        reference = extract_features(table.waveform.copy(), table.times, edge_keep_out, backend="numpy")
+        for backend in available_backends():
+            if backend == "numpy":
+                continue
+            result = extract_features(table.waveform.copy(), table.times, edge_keep_out, backend=backend)
+            for feature, expected in reference.items():
+                n_bad = np.count_nonzero(~np.isclose(result[feature], expected, rtol=rtol, atol=atol, equal_nan=True))
+                if n_bad:
+                    mismatches.append((backend, channel, feature, n_bad))
+    return mismatches
+
+
+def make_dataset(raw_dir, n_events, pmt_ids=("PMT1", "PMT2"), voltages=(1400, 1500), channels=(1,)):
+    """
+    Lays out synthetic runs under `raw_dir` the way `process_all` and `Config.id_from_path` expect them:
+    `<pmt_id>/<date>-<voltage>-<signal>.dat`.
+    """
+    paths = []
+    for pmt_idx, pmt_id in enumerate(pmt_ids):
+        for voltage_idx, voltage in enumerate(voltages):
+            path = Path(raw_dir) / pmt_id / f"2022_03_{pmt_idx + 1:02d}-{voltage}-led.dat"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            write_dat_file(path, n_events, channels=channels, amplitude=(0.01, 0.1 * (voltage_idx + 1)),
+                           seed=len(paths))
+            paths.append(path)
+    return paths
+
+
+def bench_process_all(work_dir, n_events):
+    """
+    `process_all` over a small synthetic dataset, from an empty output directory.
+    """
+    from process import process_all
+    raw_dir = Path(work_dir) / "raw"
+    n_files = len(make_dataset(raw_dir, n_events))
+    with config_override(RAW_DATA_ROOT=raw_dir, PROCESSED_DATA_ROOT=Path(work_dir) / "processed", RECREATE=True,
+                         VERBOSE=False):
+        result, failures = measure("process_all", n_files * n_events, process_all)
+    if failures:
+        raise RuntimeError(f"process_all failed on {len(failures)} file(s)")
+    return [result]
+
+
+def bench_figures(work_dir, n_events):
+    """
+    The main report figures, drawn from the output of `bench_process_all`. Each is timed with an empty summary cache
+    and again once it is filled, since the report is usually rebuilt over mostly unchanged samples.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotboard import d
+    import visualize
+
+    with config_override(PROCESSED_DATA_ROOT=Path(work_dir) / "processed", CACHE_DIR=Path(work_dir) / "cache"):
+        import summary
+        summary._summary_cache = None
+        the_config.sample_catalog(refresh=True)
+        d.clear()
+        visualize.load_data()
+        sample_ids, _ = the_config.find_samples()
+        pmt_ids = sorted(the_config.all_pmt_ids())
+        sample_id = sample_ids[0]
+        figures = {
+            "histogram": visualize.histogram(sample_id, 'area', range_=(0, 10)),
+            "histogram_2d": visualize.histogram_2d(sample_id, 'peak_v', 'area', n_bins=(300, 300),
+                                                   range_=((0, 0.4), (0, 10))),
+            "simple_waveform": visualize.simple_waveform(sample_id, 2914, 1, 0),
+            "trigger_rate_vs_time": visualize.trigger_rate_vs_time(pmt_ids),
+            "observable_comparison": visualize.observable_comparison(pmt_ids, 'area', range_=(0, 10)),
+        }
+
+        def draw(figure):
+            plt.figure()
+            figure.render_fn(*figure.args, **figure.kwargs)
+            plt.savefig(io.BytesIO(), format="png")
+            plt.close("all")
+
+        results = []
+        for cache_state in ("cold", "warm"):
+            for name, figure in figures.items():
+                results.append(measure(f"{name} ({cache_state})", n_events, lambda: draw(figure))[0])
+        d.clear()
+        summary._summary_cache = None
+    the_config.sample_catalog(refresh=True)
+    return results
+
+
+def bench_startup(work_dir, n_events):
+    """
+    Short command line invocations, each in a fresh interpreter so that import and config costs are included, over
+    the output of `bench_process_all`.
+    """
+    cli_path = Path(__file__).parent / "cli.py"
+    env = {**os.environ, "RAW_DATA_ROOT": str(Path(work_dir) / "raw"),
+           "PROCESSED_DATA_ROOT": str(Path(work_dir) / "processed"), "CACHE_DIR": str(Path(work_dir) / "cache")}
+    commands = {
+        "import visualize": (0, ["-c", "import visualize"]),
+        "cli samples": (0, [cli_path, "samples"]),
+        "cli convert": (n_events, [cli_path, "convert", Path(work_dir) / "bench.dat",
+                                   Path(work_dir) / "startup.root"]),
+    }
+    results = []
+    for name, (n_command_events, args) in commands.items():
+        result, _ = measure(name, n_command_events, lambda: subprocess.run(
+            [sys.executable, *map(str, args)], env=env, cwd=cli_path.parent, check=True, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL))
+        results.append(result)
+    return results
+
+
+def run(sizes=(1_000, 10_000, 100_000), channels=(1, 2, 3, 4), figures=True, work_dir=None):
+    """
+    Runs every benchmark at each number of events in `sizes`, printing the results as they come in.
+    """
+    results = []
+    for n_events in sizes:
+        with tempfile.TemporaryDirectory(dir=work_dir) as size_dir:
+            dat_file_path = Path(size_dir) / "bench.dat"
+            write_dat_file(dat_file_path, n_events, channels=channels)
+            size_results = bench_file(dat_file_path, size_dir, n_events)
+            size_results += bench_feature_backends(dat_file_path, n_events)
+            size_results += bench_process_all(size_dir, n_events)
+            size_results += bench_startup(size_dir, n_events)
+            if figures:
+                size_results += bench_figures(size_dir, n_events)
+        for result in size_results:
+            print(f"{result.name:<36} {result.n_events:>10} events {result.seconds:>9.3f} s "
+                  f"{result.events_per_second:>12.0f} events/s {result.peak_bytes / 1e6:>10.1f} MB peak")
+        results += size_results
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    The results that are more than `tolerance` slower, or use more than `tolerance` more memory, than the matching
+    (name, n_events) entry of `baseline`, as (result, baseline result) pairs.
+    """
+    baseline = {(entry["name"], entry["n_events"]): entry for entry in baseline}
+    regressions = []
+    for result in results:
+        reference = baseline.get((result.name, result.n_events))
+        if reference is None:
+            continue
+        if (result.seconds > (1 + tolerance) * reference["seconds"] or
+                result.peak_bytes > (1 + tolerance) * reference["peak_bytes"]):
+            regressions.append((result, reference))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks processing and plotting on synthetic DRS4 data")
+    parser.add_argument("sizes", nargs="*", type=int, default=[1_000, 10_000, 100_000],
+                        help="numbers of events to benchmark with")
+    parser.add_argument("--channels", type=int, default=4, help="channels per event")
+    parser.add_argument("--no-figures", action="store_true", help="skip the report figures")
+    parser.add_argument("--output", type=Path, help="write the results to this JSON file")
+    parser.add_argument("--baseline", type=Path, help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown relative to the baseline")
+    parser.add_argument("--check-backends", action="store_true",
+                        help="only check that every feature backend agrees with the numpy reference, failing if "
+                             "no other backend is installed")
+    args = parser.parse_args()
+
+    if args.check_backends:
+        if available_backends() == ["numpy"]:
+            # Only the reference is installed, so there would be nothing to compare it against
+            print("No feature backend besides the numpy reference is installed (is numba missing?), nothing checked")
+            raise SystemExit(1)
+        mismatches = []
+        with tempfile.TemporaryDirectory() as check_dir:
+            for pulse_shape in PULSE_SHAPES:
+                for polarity in (-1, 1):
+                    dat_file_path = Path(check_dir) / f"{pulse_shape}.dat"
+                    write_dat_file(dat_file_path, max(args.sizes), pulse_shape=pulse_shape, polarity=polarity)
+                    mismatches += check_feature_backends(dat_file_path)
+        for backend, channel, feature, n_bad in mismatches:
+            print(f"MISMATCH {backend} {channel} {feature}: {n_bad} event(s) outside tolerance")
+        print(f"Checked backends {available_backends()}: {len(mismatches)} mismatch(es)")
+        if mismatches:
+            raise SystemExit(1)
+        return
+
+    results = run(args.sizes, channels=tuple(range(1, args.channels + 1)), figures=not args.no_figures)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump([asdict(result) for result in results], output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for result, reference in regressions:
+            print(f"REGRESSION {result.name} ({result.n_events} events): {result.seconds:.3f} s vs "
+                  f"{reference['seconds']:.3f} s, {result.peak_bytes / 1e6:.1f} MB vs "
+                  f"{reference['peak_bytes'] / 1e6:.1f} MB")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+from argparse import ArgumentParser
+from importlib import import_module
+from pathlib import Path
+import sys
+import time
+
+# Each command only imports what it needs, so that quick ones like `samples` don't wait on uproot or matplotlib.
+
+
+def samples(args):
+    from config import the_config
+    sample_ids, paths = the_config.find_samples(pmt_id=args.pmt_id, date=args.date, voltage=args.voltage,
+                                                signal=args.signal)
+    for sample_id, path in zip(sample_ids, paths):
+        print("\t".join([*sample_id, str(path)]))
+    print(f"{len(sample_ids)} sample(s)", file=sys.stderr)
+
+
+def convert(args):
+    from process import convert_file
+    dat_file_path = Path(args.dat_file)
+    root_file_path = Path(args.output) if args.output else dat_file_path.with_suffix(".root")
+    convert_file(dat_file_path, root_file_path, workers=args.workers)
+
+
+def process(args):
+    from process import process_all
+    if process_all():
+        sys.exit(1)
+
+
+def report(args):
+    from visualize import main
+    main()
+
+
+def monitor(args):
+    from monitor import LiveMonitor
+    LiveMonitor(args.dat_file, args.snapshot).follow(idle_timeout=args.idle_timeout)
+
+
+# command: (function, module it needs, help)
+COMMANDS = {
+    "samples": (samples, "config", "List the processed samples, optionally only those matching the given keys"),
+    "convert": (convert, "process", "Convert one .dat file"),
+    "process": (process, "process", "Convert all pending .dat files under RAW_DATA_ROOT"),
+    "report": (report, "visualize", "Build and serve the report"),
+    "monitor": (monitor, "monitor", "Follow a .dat file that is still being written"),
+}
+
+
+def parse_args(argv=None):
+    parser = ArgumentParser(description="MilliQan PMT analysis")
+    parser.add_argument("--timing", action="store_true",
+                        help="Report the time spent starting up (imports and config) and running the command")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    commands = {name: subparsers.add_parser(name, help=help_) for name, (_, _, help_) in COMMANDS.items()}
+
+    for key in ("pmt_id", "date", "voltage", "signal"):
+        commands["samples"].add_argument(f"--{key.replace('_', '-')}", dest=key)
+    commands["convert"].add_argument("dat_file")
+    commands["convert"].add_argument("output", nargs="?", help="Output path, defaults to the .dat path with .root")
+    commands["convert"].add_argument("--workers", type=int, default=1)
+    commands["monitor"].add_argument("dat_file")
+    commands["monitor"].add_argument("--snapshot", default=None)
+    commands["monitor"].add_argument("--idle-timeout", type=float, default=None)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    function, module, _ = COMMANDS[args.command]
+
+    start = time.perf_counter()
+    import_module(module)
+    imported = time.perf_counter()
+    from config import the_config
+    the_config.resolve()
+    configured = time.perf_counter()
+    try:
+        function(args)
+    finally:
+        if args.timing:
+            done = time.perf_counter()
+            print(f"{args.command}: startup {configured - start:.3f} s (imports {imported - start:.3f} s, "
+                  f"config {configured - imported:.3f} s), command {done - configured:.3f} s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
+from collections import defaultdict
 from dataclasses import dataclass, field, fields
+from functools import lru_cache
 from os import environ
 from os.path import dirname, split, join
 from pathlib import Path
@@ -7,6 +9,18 @@ root_dir = dirname(__file__)
 data_dir = join(root_dir, 'data')
 
 
+@lru_cache(maxsize=None)
+def env_settings():
+    """
+    The settings in ./env.py, read once per process.
+    """
+    try:
+        import env
+    except ImportError:
+        return {}
+    return {name: value for name, value in vars(env).items() if not name.startswith("_")}
+
+
 @dataclass
 class Config:
     """
@@ -21,24 +35,44 @@ class Config:
     RECREATE: bool = False
     VERBOSE: bool = False
     INCLUDE_WAVEFORMS: bool = True
+    WAVEFORM_ENCODING: str = "volts"  # "volts" for float64 waveforms, "adc" for raw uint16 samples
+    WAVEFORM_SELECTION: bool = False  # Only keep the waveforms of events passing a SELECT_* cut, in a Waveforms tree
+    SELECT_AREA: list[float] = field(default_factory=lambda: [0.0, 5.0])  # Keep areas outside (low, high), "" for none
+    SELECT_WIDTH: list[float] = field(default_factory=lambda: [0.0, 200.0])  # Keep widths outside (low, high)
+    SELECT_SATURATED: bool = True  # Keep events with samples at either end of the ADC range
+    SELECT_PILEUP_FRACTION: float = 0.5  # Keep events with a second pulse above this fraction of the peak, 0 for none
+    SELECT_PRESCALE: int = 100  # Also keep a pseudo-random 1 in N events, 0 for none
+    COMPRESSION: str = "ZLIB"  # ROOT compression algorithm: ZLIB, LZMA, LZ4, ZSTD or NONE
+    COMPRESSION_LEVEL: int = 1
+    OUTPUT_FORMATS: list[str] = field(default_factory=lambda: ["root"])  # Any of "root" and "parquet"
+    PARQUET_ROW_GROUP_SIZE: int = 100_000  # Rows per Parquet row group
+    PARQUET_COMPRESSION: str = "zstd"
+    PARQUET_WAVEFORMS: bool = False  # Write waveforms to a separate <name>.waveforms.parquet
+    CHUNK_SIZE: int = 10_000  # Events decoded and processed at a time when converting
+    CHUNK_MEMORY_BYTES: int = 2_000_000_000  # Budget for processed chunks waiting to be written, with WORKERS > 1
+    CHECKPOINT_EVENTS: int = 0  # Events converted between resumable checkpoints, 0 to disable checkpointing
+    WORKERS: int = 1  # Number of processes used to convert files in parallel
+    SPLIT_FILES: bool = True  # Split each file's events across WORKERS when fewer files than workers are pending
+    FEATURE_BACKEND: str = "numpy"  # Pulse finding implementation, "numpy" or "numba" (if installed)
+    PROFILE: bool = False  # Save a cProfile of each file's conversion next to its output
     RAW_DATA_ROOT: Path = "data\\"
     PROCESSED_DATA_ROOT: Path = "processed_data\\"
     BANNED: list[str] = field(default_factory=list)  # Patterns for disallowed files
     FILES: list[str] = field(default_factory=list)  # Patterns for allowed files - overrides BANNED
+    CACHE_DIR: Path = ".cache"
+    DATA_CACHE_BYTES: int = 500_000_000  # Memory budget for decoded arrays, per process
     AAAAAAAAAH: bool = False
 
     def __post_init__(self):
+        self._sample_catalog = None
+        settings = env_settings()
         for f in fields(self):
             name = f.name
             default = getattr(self, name)
             type_ = f.type
 
             # get from ./env.py, fallback to environment variables, and then defaults
-            try:
-                import env
-                val = getattr(env, name)
-            except (ImportError, AttributeError):
-                val = environ.get(name, default)
+            val = settings[name] if name in settings else environ.get(name, default)
 
             if type_ == bool:
                 if str(val).lower() == "true":
@@ -49,8 +83,7 @@ class Config:
                     raise ValueError(f"Boolean config \"{name}\" must be True or False, found \"{val}\"")
             elif getattr(type_, "__origin__", None) == list:
                 if isinstance(val, str):
-                    import re
-                    val = re.split(',', val)
+                    val = val.split(',') if val else []
                 if (sub_type := type_.__args__[0]) in (int, float, str):
                     val = [sub_type(v) for v in val]
             else:
@@ -58,6 +91,10 @@ class Config:
 
             setattr(self, name, val)
 
+        for name in ("SELECT_AREA", "SELECT_WIDTH"):
+            if len(getattr(self, name)) not in (0, 2):
+                raise ValueError(f"Config \"{name}\" must be a (low, high) pair or empty, found {getattr(self, name)}")
+
     def get_files(self, base_dir: Path, extension: str):
         import os.path
         found_paths = []
@@ -95,36 +132,154 @@ class Config:
         return self.get_files(self.RAW_DATA_ROOT, ".dat")
 
     def id_from_path(self, path: Path):
+        """
+        The (pmt_id, date, voltage, signal) of a processed file named `<pmt_id>/.../<date>-<voltage>-<signal>.root`.
+        Raises ValueError for files that aren't named like a sample.
+        """
         from re import findall
-        date_, voltage, signal = findall(r"(\d{4}_\d{2}_\d{2})-(\d*)-(.*)\.root", path.name)[0]
+        matches = findall(r"(\d{4}_\d{2}_\d{2})-(\d*)-(.*)\.root", path.name)
+        if not matches:
+            raise ValueError(f"{path} is not named like a sample")
+        date_, voltage, signal = matches[0]
         pmt_id = list(path.relative_to(self.PROCESSED_DATA_ROOT).parents)[-2].name
         return pmt_id, date_, voltage, signal
 
+    def sample_catalog(self, refresh=False):
+        """
+        The catalog of processed samples. It is loaded once per process, and reloaded if `refresh` is set.
+        """
+        if refresh or self._sample_catalog is None:
+            self._sample_catalog = SampleCatalog.load(self)
+        return self._sample_catalog
+
     def find_samples(self, pmt_id=None, date=None, voltage=None, signal=None):
-        root_file_paths, _ = self.get_root_files()
-        samples = []
-        for root_file_path in root_file_paths:
-            sample_id = self.id_from_path(root_file_path)
-            if ((pmt_id is None or pmt_id == sample_id[0]) and (date is None or date == sample_id[1]) and
-                    (voltage is None or date == sample_id[2]) and (signal is None or date == sample_id[3])):
-                samples.append((sample_id, root_file_path))
-        return list(zip(*samples))
+        samples = self.sample_catalog().find(pmt_id=pmt_id, date=date, voltage=voltage, signal=signal)
+        return list(zip(*samples)) if samples else [(), ()]
 
     def all_pmt_ids(self):
-        samples, _ = self.find_samples()
-        return {sample[0] for sample in samples}
+        return self.sample_catalog().values("pmt_id")
 
     def all_dates(self):
-        samples, _ = self.find_samples()
-        return {sample[1] for sample in samples}
+        return self.sample_catalog().values("date")
 
     def all_voltages(self):
-        samples, _ = self.find_samples()
-        return {sample[2] for sample in samples}
+        return self.sample_catalog().values("voltage")
 
     def all_signals(self):
-        samples, _ = self.find_samples()
-        return {sample[3] for sample in samples}
+        return self.sample_catalog().values("signal")
+
+
+class SampleCatalog:
+    """
+    SampleCatalog: Index of the processed samples under PROCESSED_DATA_ROOT, keyed on (pmt_id, date, voltage, signal).
+    It is saved to CACHE_DIR and reused for as long as none of the directories it was built from have changed, so
+    the directory walk and filename parsing only happen when samples are added or removed.
+    """
+    KEYS = ("pmt_id", "date", "voltage", "signal")
+
+    def __init__(self, samples):
+        self.samples = samples  # [(sample_id, path), ...]
+        self._index = {key: defaultdict(set) for key in self.KEYS}
+        for idx, (sample_id, _) in enumerate(samples):
+            for key, value in zip(self.KEYS, sample_id):
+                self._index[key][value].add(idx)
+
+    @staticmethod
+    def _cache_path(config):
+        from hashlib import sha256
+        root_hash = sha256(str(Path(config.PROCESSED_DATA_ROOT).resolve()).encode("utf-8")).hexdigest()[:16]
+        return Path(config.CACHE_DIR) / f"sample_catalog-{root_hash}.json"
+
+    @staticmethod
+    def _dir_mtimes(base_dir, dirs):
+        import os
+        mtimes = {}
+        for dir_ in dirs:
+            try:
+                mtimes[dir_] = os.stat(os.path.join(base_dir, dir_)).st_mtime_ns
+            except FileNotFoundError:
+                return None
+        return mtimes
+
+    @classmethod
+    def load(cls, config):
+        import json
+        import os
+        from atomic import atomic_open
+        cache_path = cls._cache_path(config)
+        base_dir = Path(config.PROCESSED_DATA_ROOT)
+        try:
+            with open(cache_path) as cache_file:
+                cached = json.load(cache_file)
+            if cls._dir_mtimes(base_dir, cached["dir_mtimes"]) != cached["dir_mtimes"]:
+                raise ValueError("Sample catalog is out of date")
+            entries = cached["entries"]
+        except (OSError, ValueError, KeyError):
+            entries = []
+            dir_mtimes = {}
+            for root, _, files in os.walk(base_dir):
+                dir_mtimes[os.path.relpath(root, base_dir)] = os.stat(root).st_mtime_ns
+                for file in files:
+                    if file.endswith(".root"):
+                        path = Path(os.path.join(root, file))
+                        try:
+                            sample_id = config.id_from_path(path)
+                        except ValueError:
+                            continue  # such as the parts of a checkpointed conversion that is still going
+                        entries.append([*sample_id, path.relative_to(base_dir).as_posix()])
+            entries.sort(key=lambda entry: entry[-1])
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_open(cache_path) as cache_file:
+                json.dump({"dir_mtimes": dir_mtimes, "entries": entries}, cache_file)
+
+        samples = []
+        for *sample_id, relative_path in entries:
+            path = base_dir / relative_path
+            if config.FILES:
+                allowed = any(path.match(pattern) for pattern in config.FILES)
+            else:
+                allowed = not any(path.match(pattern) for pattern in config.BANNED)
+            if allowed:
+                samples.append((tuple(sample_id), path))
+        return cls(samples)
+
+    def find(self, pmt_id=None, date=None, voltage=None, signal=None):
+        """
+        The (sample_id, path) of each sample matching all of the given keys.
+        """
+        selected = None
+        for key, value in zip(self.KEYS, (pmt_id, date, voltage, signal)):
+            if value is None:
+                continue
+            matches = self._index[key].get(value, set())
+            selected = matches if selected is None else selected & matches
+        if selected is None:
+            return list(self.samples)
+        return [self.samples[idx] for idx in sorted(selected)]
+
+    def values(self, key):
+        return set(self._index[key])
+
+
+class LazyConfig:
+    """
+    LazyConfig: Stands in for the Config, which is only built (reading env.py and the environment) when one of its
+    fields is first used. Importing modules that refer to `the_config` therefore costs nothing.
+    """
+
+    def __init__(self):
+        object.__setattr__(self, "_config", None)
+
+    def resolve(self):
+        if self._config is None:
+            object.__setattr__(self, "_config", Config())
+        return self._config
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.resolve(), name, value)
 
 
-the_config = Config()
+the_config = LazyConfig()
@@ -0,0 +1,143 @@
+from collections import OrderedDict
+import numpy as np
+
+from config import the_config
+
+
+class ArrayCache:
+    """
+    ArrayCache: Least-recently-used cache of decoded arrays, bounded by their total size in bytes rather than by
+    the number of entries. Arrays larger than the whole budget are never cached.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._arrays = OrderedDict()
+
+    def get(self, key):
+        array = self._arrays.get(key)
+        if array is not None:
+            self._arrays.move_to_end(key)
+        return array
+
+    def put(self, key, array):
+        if array.nbytes > self.max_bytes:
+            return
+        if key in self._arrays:
+            self.n_bytes -= self._arrays.pop(key).nbytes
+        self._arrays[key] = array
+        self.n_bytes += array.nbytes
+        while self.n_bytes > self.max_bytes:
+            _, evicted = self._arrays.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+
+    def clear(self):
+        self._arrays.clear()
+        self.n_bytes = 0
+
+
+class BranchView:
+    """
+    One branch of a sample, read when `array` is called. Mirrors the uproot call used by the figures.
+    """
+
+    def __init__(self, sample, branch, tree):
+        self.sample = sample
+        self.branch = branch
+        self.tree = tree
+
+    def array(self, entry_start=None, entry_stop=None):
+        return self.sample.arrays([self.branch], entry_start, entry_stop, tree=self.tree)[self.branch]
+
+
+class SampleData:
+    """
+    SampleData: Lazy access to one processed sample. Nothing is read until a branch is asked for, only the requested
+    branches and entry range are decoded, and decoded arrays are kept in the shared byte-bounded cache. The ROOT file
+    is opened on first use, so these can be handed to worker processes cheaply.
+    """
+
+    def __init__(self, file_path, cache=None):
+        self.file_path = str(file_path)
+        self._cache = cache
+        self._root_file = None
+
+    def __getstate__(self):
+        return {"file_path": self.file_path, "_cache": None, "_root_file": None}
+
+    @property
+    def cache(self):
+        return self._cache if self._cache is not None else array_cache()
+
+    def _tree(self, tree):
+        if self._root_file is None:
+            import uproot
+            self._root_file = uproot.open(self.file_path)
+        return self._root_file[tree]
+
+    def keys(self, tree='Events'):
+        return self._tree(tree).keys()
+
+    @property
+    def num_entries(self):
+        return self._tree('Events').num_entries
+
+    def __getitem__(self, branch):
+        return BranchView(self, branch, 'Events')
+
+    def arrays(self, branches, entry_start=None, entry_stop=None, tree='Events'):
+        """
+        Decoded arrays for `branches` over entries [entry_start, entry_stop), as a dict of NumPy arrays.
+        """
+        result = {}
+        missing = []
+        for branch in branches:
+            array = self.cache.get((self.file_path, tree, branch, entry_start, entry_stop))
+            if array is None and (entry_start, entry_stop) != (None, None):
+                # A cached full branch can serve any entry range
+                full = self.cache.get((self.file_path, tree, branch, None, None))
+                if full is not None:
+                    array = full[entry_start:entry_stop]
+            if array is None:
+                missing.append(branch)
+            else:
+                result[branch] = array
+
+        if missing:
+            read = self._tree(tree).arrays(missing, entry_start=entry_start, entry_stop=entry_stop, library='np')
+            for branch in missing:
+                array = np.asarray(read[branch])
+                self.cache.put((self.file_path, tree, branch, entry_start, entry_stop), array)
+                result[branch] = array
+        return result
+
+    def close(self):
+        if self._root_file is not None:
+            self._root_file.close()
+            self._root_file = None
+
+
+_array_cache = None
+_samples = {}
+
+
+def array_cache():
+    global _array_cache
+    if _array_cache is None:
+        _array_cache = ArrayCache(the_config.DATA_CACHE_BYTES)
+    return _array_cache
+
+
+def sample_data(path):
+    """
+    The SampleData for the processed file at `path`, shared within the process.
+    """
+    path = str(path)
+    if path not in _samples:
+        _samples[path] = SampleData(path)
+    return _samples[path]
+
+
+def read_events(path, branches, entry_start=None, entry_stop=None):
+    return sample_data(path).arrays(branches, entry_start, entry_stop)
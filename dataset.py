@@ -0,0 +1,138 @@
+from pathlib import Path
+import numpy as np
+
+from config import the_config
+from data import read_events, sample_data
+from writers import ParquetWriter
+
+SAMPLE_KEYS = ("pmt_id", "date", "voltage", "signal")
+
+
+def pyarrow_available():
+    try:
+        import pyarrow.dataset
+    except ImportError:
+        return False
+    return True
+
+
+def parquet_path(root_file_path):
+    """
+    The Parquet feature table written next to a processed sample (with "parquet" in `OUTPUT_FORMATS`), or None if
+    there isn't one or it is older than the ROOT file, so left over from an earlier conversion.
+    """
+    path = Path(root_file_path).with_suffix(ParquetWriter.suffix)
+    try:
+        return path if path.stat().st_mtime_ns >= Path(root_file_path).stat().st_mtime_ns else None
+    except FileNotFoundError:
+        return None
+
+
+def schema():
+    """
+    The columns of the feature dataset: those of the Parquet feature tables, then the sample keys.
+    """
+    import pyarrow as pa
+    schema_ = ParquetWriter.feature_schema()
+    for key in SAMPLE_KEYS:
+        schema_ = schema_.append(pa.field(key, pa.string()))
+    return schema_
+
+
+def _matches(sample_id, sample_filters):
+    for key, value in zip(SAMPLE_KEYS, sample_id):
+        wanted = sample_filters.get(key)
+        if wanted is None:
+            continue
+        if not isinstance(wanted, (list, tuple, set)):
+            wanted = [wanted]
+        if value not in {str(v) for v in wanted}:
+            return False
+    return True
+
+
+def _sample_expression(sample_id):
+    import pyarrow.compute as pc
+    expression = None
+    for key, value in zip(SAMPLE_KEYS, sample_id):
+        condition = pc.field(key) == value
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def _root_table(sample_id, root_file_path, schema_):
+    """
+    The rows of one sample read from its ROOT file, for samples without an up to date Parquet table. Columns the
+    ROOT file doesn't have are null.
+    """
+    import pyarrow as pa
+    branches = [name for name in schema_.names if name in sample_data(root_file_path).keys()]
+    events = read_events(root_file_path, branches)
+    n_rows = sample_data(root_file_path).num_entries
+    sample = dict(zip(SAMPLE_KEYS, sample_id))
+    columns = []
+    for field in schema_:
+        if field.name == "entry":
+            columns.append(pa.array(np.arange(n_rows), type=field.type))
+        elif field.name in events:
+            columns.append(pa.array(events[field.name], type=field.type))
+        elif field.name in sample:
+            columns.append(pa.array([sample[field.name]] * n_rows, type=field.type))
+        else:
+            columns.append(pa.nulls(n_rows, type=field.type))
+    return pa.Table.from_arrays(columns, schema=schema_)
+
+
+def feature_dataset(**sample_filters):
+    """
+    The per-event features of every processed sample matching `sample_filters` (any of `SAMPLE_KEYS`, each a value or
+    a list of values) as one `pyarrow.dataset.Dataset`. It is made of the Parquet feature tables that process_all
+    writes next to each ROOT file, with the sample keys as columns. Those come from the processed file's path rather
+    than from the tables, so files of samples that don't match are never opened, and a filter on the sample keys
+    only opens the matching ones. Rows are stored in entry order, so filters on entry or timestamp ranges skip the
+    row groups outside them.
+
+    Samples without an up to date Parquet table are read from their ROOT files instead, which is slower but gives
+    the same rows.
+    """
+    import pyarrow.dataset as ds
+    from pyarrow.fs import LocalFileSystem
+    schema_ = schema()
+    paths, expressions, root_tables = [], [], []
+    for sample_id, root_file_path in the_config.sample_catalog().samples:
+        if not _matches(sample_id, sample_filters):
+            continue
+        path = parquet_path(root_file_path)
+        if path is None:
+            if the_config.VERBOSE:
+                print(f"{root_file_path} has no up to date Parquet feature table, reading the ROOT file instead")
+            root_tables.append(_root_table(sample_id, root_file_path, schema_))
+        else:
+            paths.append(str(path.resolve()))
+            expressions.append(_sample_expression(sample_id))
+    parts = [ds.FileSystemDataset.from_paths(paths, schema=schema_, format=ds.ParquetFileFormat(),
+                                             filesystem=LocalFileSystem(), partitions=expressions)]
+    parts.extend(ds.dataset(table) for table in root_tables)
+    return parts[0] if len(parts) == 1 else ds.dataset(parts)
+
+
+def scan_features(columns=None, filter=None, entry_start=None, entry_stop=None, time_range=None, **sample_filters):
+    """
+    The rows of `feature_dataset(**sample_filters)` matching every given condition, as a pyarrow Table with `columns`
+    (all by default). Entries are selected from [entry_start, entry_stop), `time_range` is a (start, stop) pair of
+    timestamps and `filter` is any further `pyarrow.dataset` expression, such as `pc.field('area') > 1`. All of them
+    are pushed down to the scan.
+    """
+    import pyarrow.compute as pc
+    conditions = [] if filter is None else [filter]
+    if entry_start is not None:
+        conditions.append(pc.field("entry") >= entry_start)
+    if entry_stop is not None:
+        conditions.append(pc.field("entry") < entry_stop)
+    if time_range is not None:
+        conditions.append((pc.field("timestamp") >= time_range[0]) & (pc.field("timestamp") < time_range[1]))
+
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return feature_dataset(**sample_filters).to_table(columns=columns, filter=expression)
@@ -0,0 +1,110 @@
+import numpy as np
+
+FEATURE_BACKENDS = ("numpy", "numba")
+
+
+def _row_percentiles(sorted_rows, lengths, q):
+    """
+    Linearly interpolated percentile `q` of the first `lengths[i]` entries of each row of `sorted_rows`, matching
+    `np.percentile`'s default method. Rows must already be sorted over those entries.
+    """
+    rows = np.arange(len(sorted_rows))
+    position = (lengths - 1) * (q / 100.0)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, lengths - 1)
+    frac = position - lower
+    low_v = sorted_rows[rows, lower]
+    high_v = sorted_rows[rows, upper]
+    return low_v + (high_v - low_v) * frac
+
+
+def _pulse_bounds(waveform, noise_est, peak_idx, edge_keep_out):
+    """
+    Start and end of the pulse in each row of `waveform`, clamped to be at least .25*edge_keep_out from the edge. The
+    start is one past the last pre-peak sample above the noise estimate and the end is the first post-peak sample at
+    or below it.
+    """
+    n_bins = waveform.shape[1]
+    bins = np.arange(n_bins)
+    above_noise = waveform > noise_est[:, None]
+    pre_peak = above_noise & (bins < peak_idx[:, None])
+    last_above = n_bins - 1 - np.argmax(pre_peak[:, ::-1], axis=1)
+    pulse_start_idx = np.maximum(np.where(pre_peak.any(axis=1), last_above + 1, 0), edge_keep_out//4)
+    del pre_peak
+
+    post_peak = ~above_noise & (bins >= peak_idx[:, None])
+    first_below = np.argmax(post_peak, axis=1)
+    pulse_end_idx = np.minimum(np.where(post_peak.any(axis=1), first_below, n_bins), n_bins - edge_keep_out//4)
+    return pulse_start_idx, pulse_end_idx
+
+
+def pulse_bounds_backend(backend):
+    """
+    The implementation of `_pulse_bounds` for one of `FEATURE_BACKENDS`. "numba" scans each waveform outwards from
+    its peak in compiled code, in parallel over events, and needs numba to be installed.
+    """
+    if backend == "numpy":
+        return _pulse_bounds
+    if backend == "numba":
+        from features_numba import pulse_bounds
+        return pulse_bounds
+    raise ValueError(f"Unknown feature backend \"{backend}\", expected one of {FEATURE_BACKENDS}")
+
+
+def extract_features(waveform, times, edge_keep_out, backend="numpy"):
+    """
+    Computes the pulse features of every event in `waveform`, a (n_events, n_bins) block of samples from one
+    channel, with all events handled at once. Negative pulses are inverted in place, just like the per-event
+    loop used to do, so the block holds the processed waveforms afterwards. `backend` selects how the pulse
+    bounds are found, see `pulse_bounds_backend`.
+
+    Returns a dict of feature columns: area, width, noise, peak_t, peak_v and polarity (-1 where the waveform was
+    inverted, 1 otherwise).
+    """
+    n_events, n_bins = waveform.shape
+    rows = np.arange(n_events)
+    bins = np.arange(n_bins)
+
+    # If pulse is negative, invert the waveform
+    invert = np.abs(waveform.min(axis=1)) > np.abs(waveform.max(axis=1))
+    waveform[invert] *= -1
+
+    # Here, we clip the peak to be sufficiently far from the start and end of the sample
+    peak_idx = np.clip(np.argmax(waveform, axis=1), edge_keep_out, n_bins-edge_keep_out)
+    peak_v = waveform[rows, peak_idx]
+
+    p5, p95 = np.percentile(waveform[:, :100], [5, 95], axis=1)
+    noise_est = 0.5 * (p95 - p5)
+
+    pulse_start_idx, pulse_end_idx = pulse_bounds_backend(backend)(waveform, noise_est, peak_idx, edge_keep_out)
+
+    t_peak = times[peak_idx]
+    width = times[pulse_end_idx] - times[pulse_start_idx]
+
+    # Offset and pre-pulse noise are taken from the first 3/4 of the samples before the pulse start
+    baseline_len = (pulse_start_idx * 3) // 4
+    n_baseline = baseline_len.max(initial=0)
+    baseline = waveform[:, :n_baseline]
+    in_baseline = bins[:n_baseline] < baseline_len[:, None]
+    offset = np.where(in_baseline, baseline, 0.0).sum(axis=1) / baseline_len
+
+    baseline_sorted = np.sort(np.where(in_baseline, baseline, np.inf), axis=1)
+    pre_pulse_noise = 0.5 * (_row_percentiles(baseline_sorted, baseline_len, 95) -
+                             _row_percentiles(baseline_sorted, baseline_len, 5))
+    del baseline, baseline_sorted, in_baseline
+
+    # Trapezoidal integral of the offset-subtracted waveform over [pulse_start_idx, pulse_end_idx)
+    shifted = waveform - offset[:, None]
+    segments = np.diff(times) * (shifted[:, 1:] + shifted[:, :-1]) / 2.0
+    del shifted
+    in_pulse = (bins[:-1] >= pulse_start_idx[:, None]) & (bins[:-1] < pulse_end_idx[:, None] - 1)
+    area = np.maximum(np.where(in_pulse, segments, 0.0).sum(axis=1), 0.0)
+
+    return {
+        "area": area,
+        "width": width,
+        "noise": pre_pulse_noise,
+        "peak_t": t_peak,
+        "peak_v": peak_v,
+        "polarity": np.where(invert, -1, 1).astype(np.int8),
+    }
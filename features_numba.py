@@ -0,0 +1,31 @@
+import numba
+import numpy as np
+
+
+@numba.njit(parallel=True, cache=True)
+def pulse_bounds(waveform, noise_est, peak_idx, edge_keep_out):
+    """
+    Compiled `features._pulse_bounds`. Each row is scanned outwards from its peak and stops at the first sample on
+    the far side of the noise estimate, so only the pulse itself is visited, and rows are split across threads.
+    """
+    n_events, n_bins = waveform.shape
+    pulse_start_idx = np.empty(n_events, dtype=np.int64)
+    pulse_end_idx = np.empty(n_events, dtype=np.int64)
+    for row in numba.prange(n_events):
+        peak = peak_idx[row]
+        noise = noise_est[row]
+
+        start = 0
+        for idx in range(peak - 1, -1, -1):
+            if waveform[row, idx] > noise:
+                start = idx + 1
+                break
+        pulse_start_idx[row] = max(start, edge_keep_out//4)
+
+        end = n_bins
+        for idx in range(peak, n_bins):
+            if not waveform[row, idx] > noise:
+                end = idx
+                break
+        pulse_end_idx[row] = min(end, n_bins - edge_keep_out//4)
+    return pulse_start_idx, pulse_end_idx
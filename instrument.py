@@ -0,0 +1,96 @@
+from contextlib import contextmanager
+import sys
+import time
+
+
+def peak_rss():
+    """
+    The largest resident set size of this process so far in bytes, or None where the platform doesn't report it. This
+    is a high-water mark for the whole process, so it never goes down and can't be attributed to any one piece of
+    work.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageStats:
+    """
+    StageStats: Accumulates the wall time and events and bytes handled by each named stage of a piece of work, such
+    as converting one file. Stages can be entered many times (once per chunk) and stats gathered in other processes
+    can be merged in. Each stage also records `process_peak_rss`, the process-wide `peak_rss` when the stage last
+    ended: it says how large the process had grown by then, not how much memory the stage itself used.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def _stage(self, name):
+        return self.stages.setdefault(name, {"seconds": 0.0, "events": 0, "bytes": 0, "calls": 0,
+                                             "process_peak_rss": None})
+
+    @contextmanager
+    def stage(self, name, events=0, bytes_=0):
+        """
+        Times the body as one call of stage `name`. The yielded dict's "events" and "bytes" can be added to from
+        inside the body when they are only known once the work is done.
+        """
+        counts = {"events": events, "bytes": bytes_}
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.add(name, time.perf_counter() - start, counts["events"], counts["bytes"], peak_rss())
+
+    def add(self, name, seconds, events=0, bytes_=0, process_peak_rss=None, calls=1):
+        stage = self._stage(name)
+        stage["seconds"] += seconds
+        stage["events"] += events
+        stage["bytes"] += bytes_
+        stage["calls"] += calls
+        if process_peak_rss is not None:
+            stage["process_peak_rss"] = max(stage["process_peak_rss"] or 0, process_peak_rss)
+
+    def merge(self, stages):
+        """
+        Adds in the `stages` of another StageStats.
+        """
+        for name, stage in stages.items():
+            self.add(name, stage["seconds"], stage["events"], stage["bytes"], stage["process_peak_rss"],
+                     stage["calls"])
+
+    def summary(self):
+        """
+        The stages with their throughput (events/s and MB/s) filled in, ready to be written as JSON.
+        """
+        summary = {}
+        for name, stage in self.stages.items():
+            seconds = stage["seconds"]
+            summary[name] = {
+                **stage,
+                "events_per_second": stage["events"] / seconds if seconds else None,
+                "mb_per_second": stage["bytes"] / 1e6 / seconds if seconds else None,
+            }
+        return summary
+
+
+@contextmanager
+def profiled(profile_path):
+    """
+    Runs the body under cProfile and saves the stats to `profile_path`, for `python -m pstats` or snakeviz. Does
+    nothing if `profile_path` is None.
+    """
+    if profile_path is None:
+        yield
+        return
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(profile_path)
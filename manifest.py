@@ -0,0 +1,61 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+
+from atomic import atomic_open
+
+
+def file_hash(path, block_size=1 << 24):
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        while block := file.read(block_size):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def source_stamp(path):
+    """
+    Identifies the contents of a source file: its size and mtime for a cheap check, and its hash for when those change.
+    """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_hash(path)}
+
+
+class BuildManifest:
+    """
+    BuildManifest: Records what each processed output was built from (the source file's stamp and the settings used
+    to build it) so that only outputs whose inputs have changed are rebuilt. Entries are keyed by output path.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        try:
+            with open(self.path) as manifest_file:
+                self.entries = json.load(manifest_file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def is_stale(self, key, source_path, output_path, settings):
+        entry = self.entries.get(key)
+        if entry is None or entry["settings"] != settings or not Path(output_path).is_file():
+            return True
+
+        stat = os.stat(source_path)
+        source = entry["source"]
+        if source["size"] == stat.st_size and source["mtime_ns"] == stat.st_mtime_ns:
+            return False
+        if source["size"] != stat.st_size or source["sha256"] != file_hash(source_path):
+            return True
+
+        # Touched or copied, but the contents are the same
+        source["mtime_ns"] = stat.st_mtime_ns
+        return False
+
+    def record(self, key, stamp, settings):
+        self.entries[key] = {"source": stamp, "settings": settings}
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_open(self.path) as manifest_file:
+            json.dump(self.entries, manifest_file, indent=2, sort_keys=True)
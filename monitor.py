@@ -0,0 +1,130 @@
+from pathlib import Path
+import os
+import sys
+import time
+import numpy as np
+
+from atomic import atomic_open
+from config import the_config
+from process import DRSDatFile
+from rates import RateAccumulator
+
+
+class LiveMonitor:
+    """
+    LiveMonitor: Follows a .dat file while the DAQ is still writing it. Each poll decodes only the events completed
+    since the last one, adds their features to running histograms and the trigger rate, and snapshots are written
+    periodically for the report to pick up.
+    """
+    # Fixed binning for the running feature histograms: (n_bins, range)
+    HISTOGRAMS = {
+        'area': (100, (0, 10)),
+        'width': (100, (0, 500)),
+        'noise': (100, (0, 0.005)),
+        'peak_t': (100, (0, 205)),
+        'peak_v': (100, (0, 0.5)),
+    }
+
+    def __init__(self, dat_file_path, snapshot_path=None, resolution_seconds=20, chunk_size=None):
+        self.dat_file_path = Path(dat_file_path)
+        self.snapshot_path = Path(snapshot_path) if snapshot_path is not None else self.default_snapshot_path()
+        self.chunk_size = chunk_size or the_config.CHUNK_SIZE
+        self.drs = None
+        self.n_events = 0
+        self.counts = {key: np.zeros(n_bins, dtype=np.int64) for key, (n_bins, _) in self.HISTOGRAMS.items()}
+        self.edges = {key: np.linspace(*range_, n_bins + 1) for key, (n_bins, range_) in self.HISTOGRAMS.items()}
+        self.rate = RateAccumulator(resolution_seconds)
+
+    def default_snapshot_path(self):
+        """
+        Next to where process_all will put the finished file, so the report finds it with the other samples.
+        """
+        try:
+            relative_path = self.dat_file_path.relative_to(the_config.RAW_DATA_ROOT)
+        except ValueError:
+            return self.dat_file_path.with_suffix(".live.npz")
+        return (Path(the_config.PROCESSED_DATA_ROOT) / relative_path).with_suffix(".live.npz")
+
+    def _open(self):
+        """
+        Reads the header once the file holds the header and a complete first event, which fixes the record layout.
+        """
+        try:
+            drs = DRSDatFile(self.dat_file_path, load=False, verbose=False)
+        except (OSError, ValueError):
+            return False
+        n_channels = drs._record_dtype["channels"].shape[0]
+        if drs.n_records < 1 or n_channels != len(drs.channels):
+            return False
+        self.drs = drs
+        return True
+
+    def poll(self):
+        """
+        Decodes and accumulates the events completed since the last poll. Returns the number of new events.
+        """
+        if self.drs is None and not self._open():
+            return 0
+        drs = self.drs
+        drs.n_records = (os.path.getsize(self.dat_file_path) - drs._event_offset) // drs._record_dtype.itemsize
+
+        n_new = 0
+        while self.n_events < drs.n_records:
+            stop = min(self.n_events + self.chunk_size, drs.n_records)
+            tables, complete = drs._process_chunk(self.n_events, stop)
+            for table in tables.values():
+                for key, (n_bins, range_) in self.HISTOGRAMS.items():
+                    self.counts[key] += np.histogram(table.columns[key], bins=n_bins, range=range_)[0]
+                self.rate.add(table.columns['timestamp'], table.columns['scaler'])
+            n_chunk = len(next(iter(tables.values()))) if tables else 0
+            self.n_events += n_chunk
+            n_new += n_chunk
+            if not complete:
+                break
+        return n_new
+
+    def snapshot(self):
+        bin_times, mean_scaler, start = self.rate.result()
+        snapshot = {
+            'source': np.array(str(self.dat_file_path)),
+            'updated': np.array(time.time()),
+            'n_events': np.array(self.n_events),
+            'rate_bin_times': bin_times,
+            'rate_mean_scaler': mean_scaler,
+            'rate_start': np.array(np.nan if start is None else start),
+        }
+        for key in self.HISTOGRAMS:
+            snapshot[f'{key}_counts'] = self.counts[key]
+            snapshot[f'{key}_edges'] = self.edges[key]
+
+        self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_open(self.snapshot_path, "wb") as snapshot_file:
+            np.savez(snapshot_file, **snapshot)
+
+    def follow(self, poll_interval=1.0, snapshot_interval=10.0, idle_timeout=None):
+        """
+        Polls the file until it has seen no new events for `idle_timeout` seconds (forever if None) or is
+        interrupted, writing a snapshot every `snapshot_interval` seconds and once more at the end.
+        """
+        last_snapshot = last_data = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                if self.poll():
+                    last_data = now
+                    print(f"\rMonitoring {self.dat_file_path.name}: {self.n_events} events", end="")
+                elif idle_timeout is not None and now - last_data > idle_timeout:
+                    break
+                if now - last_snapshot > snapshot_interval:
+                    self.snapshot()
+                    last_snapshot = now
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        print()
+        self.snapshot()
+        print(f"Wrote snapshot to {self.snapshot_path}")
+
+
+if __name__ == "__main__":
+    LiveMonitor(sys.argv[1]).follow()
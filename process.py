@@ -1,17 +1,39 @@
-from collections import defaultdict
-from dataclasses import dataclass
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from itertools import islice
 from pathlib import Path
-import struct
+import hashlib
+import json
+import mmap
 import os
 import os.path
+import time
+import traceback
 import numpy as np
 
+from atomic import atomic_open
 from config import the_config
+from features import extract_features, pulse_bounds_backend
+from instrument import StageStats, peak_rss, profiled
+from manifest import BuildManifest
+from selection import selected_events, selection_flags
+from writers import RootWriter, commit_all, interleave_channels, waveform_encodings, writer_types
+
+# Modules and config fields that determine the contents of processed files
+PROCESSING_CODE = ("process.py", "features.py", "features_numba.py", "selection.py", "writers.py")
+OUTPUT_SETTINGS = ("INCLUDE_WAVEFORMS", "WAVEFORM_ENCODING", "WAVEFORM_SELECTION", "SELECT_AREA", "SELECT_WIDTH",
+                   "SELECT_SATURATED", "SELECT_PILEUP_FRACTION", "SELECT_PRESCALE", "COMPRESSION", "COMPRESSION_LEVEL",
+                   "OUTPUT_FORMATS", "PARQUET_ROW_GROUP_SIZE", "PARQUET_COMPRESSION", "PARQUET_WAVEFORMS")
 
 
 @dataclass
 class Event:
+    """
+    A view of a single event in an `EventTable`. The waveform is a row of the table's waveform block and the times
+    are shared by every event on the channel, so building one of these copies no sample data.
+    """
     id: int
     board: int
     channel: int
@@ -20,234 +42,880 @@ class Event:
     range_center: int
     scaler: float
     datetime: datetime
+    area: float = None
+    width: float = None
+    noise: float = None
+    peak_t: float = None
+    peak_v: float = None
+
+
+@dataclass
+class EventTable:
+    """
+    EventTable: Array-backed storage for all events of one (board, channel). Each per-event field is one entry of
+    `columns`, and the waveforms are a single (n_events, N_BINS) block.
+    """
+    board: int
+    channel: int
+    times: np.ndarray
+    waveform: np.ndarray
+    adc: np.ndarray = None  # raw samples, the same shape as `waveform`
+    columns: dict[str, np.ndarray] = field(default_factory=dict)
+
+    FEATURES = ("area", "width", "noise", "peak_t", "peak_v")
+
+    def __len__(self):
+        return len(self.columns["id"])
+
+    def __getitem__(self, idx):
+        return Event(
+            id=int(self.columns["id"][idx]),
+            board=self.board,
+            channel=self.channel,
+            waveform=self.waveform[idx],
+            times=self.times,
+            range_center=int(self.columns["range_center"][idx]),
+            scaler=int(self.columns["scaler"][idx]),
+            datetime=datetime.fromtimestamp(self.columns["timestamp"][idx]),
+            **{feature: float(self.columns[feature][idx]) for feature in self.FEATURES if feature in self.columns})
+
+    def __iter__(self):
+        return (self[idx] for idx in range(len(self)))
+
+
+def adc_to_volts(adc, range_center, polarity=1):
+    """
+    Converts raw 16-bit DRS4 samples to volts. `range_center` (in mV) and `polarity` are per event, so `adc` is
+    (n_events, n_bins) and they are (n_events,), or all are for a single event. A polarity of -1 reproduces the
+    inversion applied to negative pulses during processing.
+    """
+    range_center = np.asarray(range_center)[..., None]
+    polarity = np.asarray(polarity)[..., None]
+    return polarity * (adc / 65535.0 + (range_center / 1000.0) - 0.5)
+
+
+def _local_timestamps(records):
+    """
+    Converts the wall-clock fields of the event records to POSIX timestamps, treating them as local time like
+    `datetime.timestamp` does. The UTC offset is looked up once per distinct hour rather than once per event.
+    """
+    dates = ((records["year"].astype(np.int64) - 1970).astype("M8[Y]") +
+             (records["month"].astype(np.int64) - 1).astype("m8[M]") +
+             (records["day"].astype(np.int64) - 1).astype("m8[D]"))
+    naive_seconds = (dates.astype("M8[s]").astype(np.int64) + 3600*records["hour"].astype(np.int64) +
+                     60*records["minute"].astype(np.int64) + records["second"].astype(np.int64))
+    hours, inverse = np.unique(naive_seconds // 3600, return_inverse=True)
+    utc_offsets = np.array([(datetime(1970, 1, 1) + timedelta(hours=int(hour))).timestamp() - 3600*int(hour)
+                            for hour in hours], dtype=np.float64)
+    return naive_seconds + utc_offsets[inverse] + records["millisecond"] / 1000.0
 
 
 class DRSDatFile:
     N_BINS = 1024  # number of timing bins per channel
-    MAX_EVENTS = 1_000_000
 
     EARLY_SPLIT = 300
     EDGE_PEAK_KEEP_OUT = 10  # Clamp peak to be at least this far from the edges
 
-    def __init__(self, path):
+    def __init__(self, path, load=True, verbose=True):
+        """
+        Reads the file header. If `load` is set, all events are decoded and processed up front; otherwise they can be
+        streamed with `iter_chunks` or `convert` without holding the whole file in memory. Progress messages are only
+        printed if `verbose` is set. Time spent in each stage of the work is gathered in `stats`.
+        """
         self.path = path
-        self.file = None
+        self.verbose = verbose
+        self.stats = StageStats()
         self.channels = []
         self.bin_widths = {}
-        self._events = defaultdict(list)
-        with open(self.path, "rb") as file:
-            self.file = file
+        self._events = {}
+        self._index = None
+        self._sha256 = None  # of the file's first `_size` bytes, once `iter_chunks` has been through them all
+        with open(self.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            self._size = len(data)
+            self._mtime_ns = os.fstat(file.fileno()).st_mtime_ns
+            self._event_offset = self._parse_header(data)
+            self._record_dtype = self._event_dtype(self._channels_per_event(data, self._event_offset))
+            self.n_records = (len(data) - self._event_offset) // self._record_dtype.itemsize
+        if load:
             self._parse()
-            self.file = None
-        self._process()
-
-    def _get_str(self, length):
-        data = self.file.read(length)
-        if len(data) == 0:
-            return None
-        res = struct.unpack("c" * len(data), data)
-        res = b"".join(res).decode("utf-8")
-        return res
-
-    def _get_short(self, num=1):
-        data = self.file.read(2 * num)
-        if len(data) == 0:
-            return None
-        try:
-            res = struct.unpack("H" * num, data)
-        except struct.error:
-            res = [0] * num
-        return res[0] if num == 1 else np.array(res, dtype=np.int16)
-
-    def _get_float(self, num=1):
-        data = self.file.read(4 * num)
-        if len(data) == 0:
-            return None
-        res = struct.unpack("f" * num, data)
-        return res[0] if num == 1 else np.array(res, dtype=np.float32)
-
-    def _get_int(self, num=1):
-        data = self.file.read(4 * num)
-        if len(data) == 0:
-            return None
-        res = struct.unpack("I" * num, data)
-        return res[0] if num == 1 else np.array(res, dtype=np.int32)
-
-    def _parse(self):
-        file_header = self._get_str(4)
-        if file_header != "DRS2":
+            self._process()
+
+    def _log(self, *args, **kwargs):
+        if self.verbose:
+            print(*args, **kwargs)
+
+    def _event_dtype(self, n_channels):
+        """
+        Layout of one fixed-stride event record: the EHDR block followed by the board/trigger tags and
+        `n_channels` channel blocks.
+        """
+        return np.dtype([
+            ("ehdr", "S4"),
+            ("serial_number", "<u4"),
+            ("year", "<u2"),
+            ("month", "<u2"),
+            ("day", "<u2"),
+            ("hour", "<u2"),
+            ("minute", "<u2"),
+            ("second", "<u2"),
+            ("millisecond", "<u2"),
+            ("range_center", "<u2"),
+            ("board_tag", "S2"),
+            ("board", "<u2"),
+            ("trigger_tag", "S2"),
+            ("trigger_cell", "<u2"),
+            ("channels", [
+                ("channel_tag", "S1"),
+                ("channel", "S3"),
+                ("scaler", "<u4"),
+                ("waveform", "<u2", (self.N_BINS,)),
+            ], (n_channels,)),
+        ])
+
+    def _parse_header(self, data):
+        """
+        Parses the DRS2/TIME header at the start of `data`, filling in the channel list and bin widths. Returns the
+        offset of the first event record.
+        """
+        if (file_header := bytes(data[0:4]).decode("utf-8")) != "DRS2":
             raise ValueError("ERROR: unrecognized header " + file_header)
-
-        timing_header = self._get_str(4)
-        if timing_header != "TIME":
+        if (timing_header := bytes(data[4:8]).decode("utf-8")) != "TIME":
             raise ValueError("ERROR: unrecognized time header " + timing_header)
 
         # Parse board information
-        while True:
-            board_header = self._get_str(2)
-            if board_header != "B#":
-                self.file.seek(-2, 1)
-                break
-            board_number = self._get_short()
-            print(f"Found board {board_number}")
+        pos = 8
+        while data[pos:pos+2] == b"B#":
+            board_number = int(np.frombuffer(data, dtype="<u2", count=1, offset=pos+2)[0])
+            self._log(f"Found board {board_number}")
+            pos += 4
 
             # Parse channel information
-            while True:
-                test = self._get_str(1)
-                if test != "C":
-                    self.file.seek(-1, 1)
-                    break
-
-                channel_number = int(self._get_str(3))
-                print("Found channel #" + str(channel_number))
+            while data[pos:pos+1] == b"C":
+                channel_number = int(bytes(data[pos+1:pos+4]).decode("utf-8"))
+                self._log("Found channel #" + str(channel_number))
                 self.channels.append((board_number, channel_number))
-                self.bin_widths[(board_number, channel_number)] = self._get_float(self.N_BINS)
-
-        # Parse event information
-        event_count = 0
-        while True:
-            event_header = self._get_str(4)
-            if event_header != "EHDR":
-                self.file.seek(-4, 1)
-                break
-            event_count += 1
-            if not event_count % 1000:
-                print(f"\rFound {event_count} events", end="")
-            if event_count > self.MAX_EVENTS:
-                print("Hit max number of events. Stopping now")
-                break
+                self.bin_widths[(board_number, channel_number)] = np.frombuffer(data, dtype="<f4", count=self.N_BINS,
+                                                                                offset=pos+4).copy()
+                pos += 4 + 4*self.N_BINS
+        return pos
+
+    def _channels_per_event(self, data, offset):
+        """
+        Counts the channel blocks in the event record at `offset`. Every event in a file carries the same channels, so
+        this fixes the record stride for the whole file.
+        """
+        pos = offset + self._event_dtype(0).itemsize
+        n_channels = 0
+        while data[pos:pos+1] == b"C":
+            n_channels += 1
+            pos += 8 + 2*self.N_BINS
+        return n_channels
+
+    def _records(self):
+        """
+        Structured view of all event records in the file. The records all share one stride, so the whole event stream
+        can be decoded without touching the individual fields from Python. The view is backed by a read-only memory
+        map that stays open for as long as the view (or any slice of it) is alive.
+        """
+        with open(self.path, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return np.ndarray(shape=(self.n_records,), dtype=self._record_dtype, buffer=data, offset=self._event_offset)
+
+    @staticmethod
+    def _check_records(records):
+        """
+        Trims `records` at the first record that is not an event, like the end of the file, and checks the rest.
+        Every record must come from the same board and channels as the first, since they are decoded as one block.
+        """
+        is_event = records["ehdr"] == b"EHDR"
+        if not is_event.all():
+            records = records[:np.argmin(is_event)]
+        if not len(records):
+            return records
+
+        bad_format = ((records["board_tag"] != b"B#") | (records["trigger_tag"] != b"T#") |
+                      (records["channels"]["channel_tag"] != b"C").any(axis=1) |
+                      (records["board"] != records["board"][0]) |
+                      (records["channels"]["channel"] != records["channels"]["channel"][0]).any(axis=1))
+        if bad_format.any():
+            raise ValueError(f"Bad format for event {records['serial_number'][np.argmax(bad_format)]}")
+        return records
+
+    def _decode(self, records):
+        """
+        Decodes a block of event records into one EventTable per (board, channel).
+        """
+        if not len(records):
+            return {}
+
+        board_number = int(records["board"][0])
+        # The raw samples are only kept if they are written out or needed to find saturated events
+        keep_adc = the_config.WAVEFORM_ENCODING == "adc" or (the_config.WAVEFORM_SELECTION and
+                                                              the_config.SELECT_SATURATED)
+        columns = {
+            "id": records["serial_number"].astype(np.int64),
+            "range_center": records["range_center"].astype(np.int64),
+            "timestamp": _local_timestamps(records),
+        }
+        tables = {}
+        for channel_idx, channel_number in enumerate(int(c) for c in records["channels"]["channel"][0]):
+            channel = records["channels"][:, channel_idx]
+            tables[(board_number, channel_number)] = EventTable(
+                board=board_number,
+                channel=channel_number,
+                times=np.cumsum(self.bin_widths[(board_number, channel_number)]),
+                waveform=adc_to_volts(channel["waveform"], columns["range_center"]),
+                adc=channel["waveform"].copy() if keep_adc else None,
+                columns={**columns, "scaler": channel["scaler"].astype(np.int64)})
+        return tables
+
+    def _read(self, records):
+        """
+        Checks and decodes `records`, counted in the "decode" stage. Returns the EventTables and the number of records
+        that were events.
+        """
+        with self.stats.stage("decode") as counts:
+            checked = self._check_records(records)
+            tables = self._decode(checked)
+            counts["events"] += len(checked)
+            counts["bytes"] += checked.nbytes
+        return tables, len(checked)
+
+    def _extract_features(self, tables):
+        """
+        Fills in the features of each EventTable in `tables`, counted in the "features" stage.
+        """
+        with self.stats.stage("features") as counts:
+            for table in tables.values():
+                table.columns.update(extract_features(table.waveform, table.times, self.EDGE_PEAK_KEEP_OUT,
+                                                      backend=the_config.FEATURE_BACKEND))
+                counts["bytes"] += table.waveform.nbytes
+            counts["events"] += len(next(iter(tables.values()))) if tables else 0
+
+    def _select(self, tables):
+        """
+        With `WAVEFORM_SELECTION` set, fills in the "selection" column (see `selection.SELECTION_FLAGS`) of each
+        EventTable in `tables`, counted in the "select" stage. The features must already be filled in.
+        """
+        if not the_config.WAVEFORM_SELECTION:
+            return
+        with self.stats.stage("select") as counts:
+            for table in tables.values():
+                table.columns["selection"] = selection_flags(table)
+            counts["events"] += len(next(iter(tables.values()))) if tables else 0
 
-            event_serial_number = self._get_int()
-            year = self._get_short()
-            month = self._get_short()
-            day = self._get_short()
-            hour = self._get_short()
-            minute = self._get_short()
-            second = self._get_short()
-            millisecond = self._get_short()
-            dt = datetime(year=year, month=month, day=day, hour=hour,
-                          minute=minute, second=second, microsecond=millisecond*1000)
-            range_center = self._get_short()
-
-            if self._get_str(2) != "B#":
-                raise ValueError(f"Bad format for event {event_serial_number}")
-            board_number = self._get_short()
-
-            if self._get_str(2) != "T#":
-                raise ValueError(f"Bad format for event {event_serial_number}")
-            trigger_cell = self._get_short()
-
-            # Read event info for each channel
-            while True:
-                if self._get_str(1) != "C":
-                    self.file.seek(-1, 1)
-                    break
-                channel_number = int(self._get_str(3))
-                channel_scaler = self._get_int()
-                waveform = self._get_short(self.N_BINS)
-                waveform = waveform/65535.0 + (range_center/1000.0) - 0.5
-                event = Event(
-                    id=event_serial_number,
-                    board=board_number,
-                    channel=channel_number,
-                    waveform=waveform,
-                    times=np.cumsum(self.bin_widths[(board_number, channel_number)]),
-                    range_center=range_center,
-                    scaler=channel_scaler,
-                    datetime=dt)
-                self._events[(board_number, channel_number)].append(event)
-        print()
+    def _parse(self):
+        self._events, n_events = self._read(self._records())
+        self._log(f"Found {n_events} events")
 
     def _process(self):
-        for channel in self.channels:
-            n_events = len(self._events[channel])
-            for event in self._events[channel]:
-                if not event.id % 1000:
-                    print(f"\rProcessing event {channel}:{event.id} ({100*event.id/n_events:.2f}%)       ", end="")
-
-                # If pulse is negative, invert the waveform
-                if abs(min(event.waveform)) > abs(max(event.waveform)):
-                    event.waveform *= -1
-
-                # Here, we clip the peak to be sufficiently far from the start and end of the sample
-                peak_idx = np.clip(np.argmax(event.waveform),
-                                   self.EDGE_PEAK_KEEP_OUT,
-                                   self.N_BINS-self.EDGE_PEAK_KEEP_OUT)
-                peak_v = event.waveform[peak_idx]
-
-                pre_peak_waveform = event.waveform[:peak_idx]
-                post_peak_waveform = event.waveform[peak_idx:]
-                noise_est = 0.5 * (np.percentile(event.waveform[:100], 95) - np.percentile(event.waveform[:100], 5))
-
-                # Start and end of pulse is clamped to be at least .25*EDGE_PEAK_KEEP_OUT from the edge
-                try:
-                    pulse_start_idx = max(np.nonzero(pre_peak_waveform > noise_est)[0][-1]+1,
-                                          self.EDGE_PEAK_KEEP_OUT//4)
-                except IndexError:
-                    pulse_start_idx = self.EDGE_PEAK_KEEP_OUT//4
-                try:
-                    pulse_end_idx = min(np.nonzero(post_peak_waveform <= noise_est)[0][0]+peak_idx,
-                                        self.N_BINS - self.EDGE_PEAK_KEEP_OUT//4)
-                except IndexError:
-                    pulse_end_idx = self.N_BINS - self.EDGE_PEAK_KEEP_OUT//4
-
-                t_peak = event.times[peak_idx]
-                offset = np.mean(event.waveform[:int(pulse_start_idx * 3 / 4)])
-                width = event.times[pulse_end_idx] - event.times[pulse_start_idx]
-                pre_pulse_noise = 0.5 * (np.percentile(event.waveform[:int(pulse_start_idx * 3 / 4)], 95) -
-                                         np.percentile(event.waveform[:int(pulse_start_idx * 3 / 4)], 5))
-
-                event.waveform = event.waveform - offset
-                area = max(np.trapz(event.waveform[pulse_start_idx:pulse_end_idx],
-                                    event.times[pulse_start_idx:pulse_end_idx]),
-                           0.0)
-                event.waveform = event.waveform + offset
-
-                event.area = area
-                event.width = width
-                event.noise = pre_pulse_noise
-                event.peak_t = t_peak
-                event.peak_v = peak_v
-        print()
+        for channel, table in self._events.items():
+            self._log(f"Processing channel {channel}: {len(table)} events")
+        self._extract_features(self._events)
+        self._select(self._events)
+
+    def _process_chunk(self, start, stop):
+        """
+        Decodes and processes event records [start, stop). Returns the EventTables and whether the chunk ran to `stop`
+        without hitting the end of the events.
+        """
+        chunk = self._records()[start:stop]
+        tables, n_events = self._read(chunk)
+        self._extract_features(tables)
+        self._select(tables)
+        return tables, n_events == len(chunk)
+
+    @staticmethod
+    def _drop_waveforms(tables, waveforms):
+        """
+        Drops the waveform blocks of `tables` whose encoding ("volts" for `waveform`, "adc" for `adc`) isn't in
+        `waveforms`, once the features and selection no longer need them.
+        """
+        for table in tables.values():
+            if "volts" not in waveforms:
+                table.waveform = None
+            if "adc" not in waveforms:
+                table.adc = None
+
+    def _chunk_nbytes(self, chunk_size, waveforms):
+        """
+        Roughly how much memory the processed EventTables of one chunk take up, keeping the `waveforms` encodings.
+        """
+        n_columns = len(EventTable.FEATURES) + 6  # id, range_center, timestamp, scaler, polarity, selection
+        bytes_per_event = 8*n_columns + self.N_BINS * (8*("volts" in waveforms) + 2*("adc" in waveforms))
+        return chunk_size * max(len(self.channels), 1) * bytes_per_event
+
+    def _iter_chunk_results(self, chunk_size, workers, start=0, waveforms=("volts", "adc")):
+        """
+        Yields `_process_chunk` results in event order, beginning with record `start`. With `workers` > 1, chunks are
+        processed by a pool of processes, keeping a bounded number in flight so memory stays proportional to the chunk
+        size: at most 2 per worker, and no more than fit in `CHUNK_MEMORY_BYTES`. Workers only send back the waveform
+        blocks in `waveforms` (see `_drop_waveforms`).
+        """
+        starts = iter(range(start, self.n_records, chunk_size))
+        if workers <= 1:
+            for start in starts:
+                yield self._process_chunk(start, start + chunk_size)
+            return
+
+        max_in_flight = max(1, min(2*workers, the_config.CHUNK_MEMORY_BYTES // self._chunk_nbytes(chunk_size,
+                                                                                                  waveforms)))
+        waveforms = tuple(waveforms)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            in_flight = deque()
+            for start in islice(starts, max_in_flight):
+                in_flight.append(pool.submit(_process_chunk_worker, self.path, start, start + chunk_size, waveforms))
+            while in_flight:
+                tables, complete, stages = in_flight.popleft().result()
+                self.stats.merge(stages)
+                yield tables, complete
+                if not complete:
+                    for future in in_flight:
+                        future.cancel()
+                    break
+                for start in islice(starts, 1):
+                    in_flight.append(pool.submit(_process_chunk_worker, self.path, start, start + chunk_size,
+                                                 waveforms))
+
+    def _hash_bytes(self, hasher, data, start, stop, block_size=1 << 24):
+        """
+        Feeds bytes [start, stop) of the memory-mapped file `data` to `hasher`, counted in the "hash" stage.
+        """
+        with self.stats.stage("hash", bytes_=stop - start):
+            for pos in range(start, stop, block_size):
+                hasher.update(data[pos:min(pos + block_size, stop)])
+
+    def _record_offset(self, record):
+        return self._event_offset + record * self._record_dtype.itemsize
+
+    def iter_chunks(self, chunk_size, workers=1, start=0, waveforms=("volts", "adc")):
+        """
+        Decodes and processes the file `chunk_size` events at a time, yielding a dict of EventTables for each chunk.
+        Only the current chunk (or, with `workers` > 1, the chunks in flight) is held in memory. Records before
+        `start` are skipped. With `workers` > 1, only the waveform encodings in `waveforms` are kept.
+
+        The file is hashed along the way, each chunk's bytes right after it is decoded, so that `source_stamp` doesn't
+        have to read the whole file a second time.
+        """
+        hasher = hashlib.sha256()
+        with open(self.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # The header, and any records skipped when resuming
+            self._hash_bytes(hasher, data, 0, self._record_offset(start))
+            n_done = record = start
+            for tables, complete in self._iter_chunk_results(chunk_size, workers, start, waveforms):
+                stop = min(record + chunk_size, self.n_records)
+                self._hash_bytes(hasher, data, self._record_offset(record), self._record_offset(stop))
+                record = stop
+                n_done += len(next(iter(tables.values()))) if tables else 0
+                progress = n_done / self.n_records if self.n_records else 1.0
+                self._log(f"\rProcessing events {n_done} of {self.n_records} ({progress:.0%})", end="")
+                yield tables
+                if not complete:
+                    break
+            # Whatever follows the last record read, such as a partly written one
+            self._hash_bytes(hasher, data, self._record_offset(record), self._size)
+        self._sha256 = hasher.hexdigest()
+        self._log()
+
+    def source_stamp(self):
+        """
+        The `manifest.source_stamp` of the file as it was when it was opened, with the hash taken by `iter_chunks`.
+        None until `iter_chunks` has run to the end of the file.
+        """
+        if self._sha256 is None:
+            return None
+        return {"size": self._size, "mtime_ns": self._mtime_ns, "sha256": self._sha256}
+
+    def _root_branches(self, tables):
+        """
+        Flattens EventTables into the branches of the Events tree, one entry per (event, channel) in event-major order
+        (see `writers.interleave_channels`). With
+        `WAVEFORM_SELECTION` set, the waveforms are left out (see `_waveform_branches`) and each entry carries the
+        "selection" flags of its event on its channel.
+        """
+        fields = ['id', 'board', 'channel', 'scaler',
+                  'area', 'width', 'noise', 'peak_t', 'peak_v', 'timestamp']
+        include_waveforms = the_config.INCLUDE_WAVEFORMS and not the_config.WAVEFORM_SELECTION
+        adc_encoding = include_waveforms and the_config.WAVEFORM_ENCODING == "adc"
+        if adc_encoding:
+            fields += ['range_center', 'polarity']
+        if the_config.WAVEFORM_SELECTION:
+            fields += ['selection']
+        events = {name: [] for name in fields}
+        if include_waveforms:
+            events['waveform_adc' if adc_encoding else 'waveform'] = []
+        for table in tables:
+            n_events = len(table)
+            for name in fields:
+                if name == 'board':
+                    events[name].append(np.full(n_events, table.board, dtype=np.int64))
+                elif name == 'channel':
+                    events[name].append(np.full(n_events, table.channel, dtype=np.int64))
+                else:
+                    events[name].append(table.columns[name])
+            if adc_encoding:
+                events['waveform_adc'].append(table.adc)
+            elif include_waveforms:
+                events['waveform'].append(table.waveform)
+
+        for key, val in events.items():
+            events[key] = interleave_channels(val)
+        return events
+
+    def _waveform_branches(self, tables, entry_start):
+        """
+        The branches of the Waveforms tree for a chunk of EventTables whose Events entries begin at `entry_start`:
+        the waveform on every channel of each event that passed the selection, along with the "entry" of that
+        (event, channel) in the Events tree. Entries are in increasing order, so a range of Events entries can be
+        looked up with a binary search.
+        """
+        tables = list(tables)
+        adc_encoding = the_config.WAVEFORM_ENCODING == "adc"
+        fields = ['entry', 'id', 'board', 'channel'] + (['range_center', 'polarity'] if adc_encoding else [])
+        waveform_name = 'waveform_adc' if adc_encoding else 'waveform'
+        branches = {name: [] for name in fields + [waveform_name]}
+        kept = np.flatnonzero(selected_events(tables))
+        for table_idx, table in enumerate(tables):
+            for name in fields:
+                if name == 'entry':
+                    branches[name].append(entry_start + kept*len(tables) + table_idx)
+                elif name == 'board':
+                    branches[name].append(np.full(len(kept), table.board, dtype=np.int64))
+                elif name == 'channel':
+                    branches[name].append(np.full(len(kept), table.channel, dtype=np.int64))
+                else:
+                    branches[name].append(table.columns[name][kept])
+            branches[waveform_name].append((table.adc if adc_encoding else table.waveform)[kept])
+
+        for key, val in branches.items():
+            branches[key] = interleave_channels(val)
+        return branches
+
+    def _calibration_branches(self):
+        """
+        The time axis of each channel. It depends only on the channel's bin widths, so it is stored once per channel
+        in the Calibration tree rather than with every event.
+        """
+        return {
+            'board': np.array([board for board, _ in self.channels], dtype=np.int64),
+            'channel': np.array([channel for _, channel in self.channels], dtype=np.int64),
+            'times': np.array([np.cumsum(self.bin_widths[channel]) for channel in self.channels],
+                              dtype=np.float32).reshape(-1, self.N_BINS),
+        }
+
+    def _serialize(self, tables):
+        """
+        `_root_branches` for a dict of EventTables, counted in the "serialize" stage.
+        """
+        with self.stats.stage("serialize") as counts:
+            branches = self._root_branches(tables.values())
+            counts["events"] += len(next(iter(tables.values()))) if tables else 0
+            counts["bytes"] += sum(branch.nbytes for branch in branches.values())
+        return branches
+
+    def _serialize_waveforms(self, tables, entry_start):
+        """
+        `_waveform_branches` for a dict of EventTables, counted in the "serialize" stage.
+        """
+        with self.stats.stage("serialize") as counts:
+            branches = self._waveform_branches(tables.values(), entry_start)
+            counts["bytes"] += sum(branch.nbytes for branch in branches.values())
+        return branches
 
     def to_root(self, root_file_path):
-        import uproot
-        root_file = uproot.recreate(root_file_path)
-
-        events = defaultdict(list)
-        for channel in self.channels:
-            for event in self._events[channel]:
-
-                fields = ['id', 'board', 'channel', 'scaler',
-                          'area', 'width', 'noise', 'peak_t', 'peak_v']
-                if the_config.INCLUDE_WAVEFORMS:
-                    fields.append('times')
-                    fields.append('waveform')
-                for field in fields:
-                    events[field].append(getattr(event, field))
-                events['timestamp'].append(event.datetime.timestamp())
+        writer = RootWriter(self, root_file_path)
+        writer.write(self._events)
+        writer.close()
+        writer.commit()
+
+    @staticmethod
+    def _write(writers, chunks):
+        """
+        Writes each chunk of EventTables to all of `writers` and closes them, discarding their outputs on failure.
+        """
+        try:
+            for tables in chunks:
+                for writer in writers:
+                    writer.write(tables)
+            for writer in writers:
+                writer.close()
+        except BaseException:
+            for writer in writers:
+                writer.abort()
+            raise
+
+    def convert(self, output_path, chunk_size=None, workers=1, checkpoint_events=None, formats=None):
+        """
+        Streams the file into each of `formats` (default `OUTPUT_FORMATS`, see `writers.WRITERS`), written to
+        `output_path` with the suffix of the format. Peak memory is set by `chunk_size` (default `CHUNK_SIZE`) rather
+        than by the size of the file. With `workers` > 1, the chunks are decoded and processed in parallel and written
+        in event order.
+
+        Outputs are written under temporary names and only renamed into place once they are all complete, so an
+        interrupted conversion never leaves behind a file that looks finished. With `checkpoint_events` (default
+        `CHECKPOINT_EVENTS`) set, the conversion can also be resumed, see `_convert_checkpointed`.
+        """
+        output_path = Path(output_path)
+        chunk_size = chunk_size or the_config.CHUNK_SIZE
+        if checkpoint_events is None:
+            checkpoint_events = the_config.CHECKPOINT_EVENTS
+        types = writer_types(formats or the_config.OUTPUT_FORMATS)
+        if checkpoint_events > 0:
+            self._convert_checkpointed(output_path, types, chunk_size, workers, checkpoint_events)
+            return
+
+        writers = [writer_type(self, output_path.with_suffix(writer_type.suffix)) for writer_type in types]
+        self._write(writers, self.iter_chunks(chunk_size, workers=workers, waveforms=waveform_encodings(types)))
+        commit_all(writers)
+
+    def _load_checkpoint(self, checkpoint_path, settings):
+        """
+        The saved progress of a conversion, if it was made from this version of the raw file with the same settings
+        and all of its parts are still there. Otherwise, a fresh checkpoint at the first event.
+        """
+        stat = os.stat(self.path)
+        try:
+            with open(checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            if (checkpoint["source_size"] == stat.st_size and checkpoint["source_mtime_ns"] == stat.st_mtime_ns and
+                    checkpoint["settings"] == settings and
+                    all((checkpoint_path.parent / name).exists() for part in checkpoint["parts"]
+                        for name in part["files"])):
+                return checkpoint
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return {"source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns, "settings": settings,
+                "next_record": 0, "offset": self._event_offset, "parts": []}
+
+    def _convert_checkpointed(self, output_path, types, chunk_size, workers, checkpoint_events):
+        """
+        Converts the file as a series of parts of at least `checkpoint_events` events each, kept in an
+        `<output>.parts` directory with one file per output format. After each part is finished, a checkpoint records
+        the parts written so far and the record (and byte offset) the next one starts from, so an interrupted
+        conversion resumes from the last checkpoint rather than from the start of the file. Once every event is
+        written, the parts of each format are merged into its output and the directory is removed.
+        """
+        import shutil
+        parts_dir = output_path.with_name(output_path.name + ".parts")
+        parts_dir.mkdir(parents=True, exist_ok=True)
+        checkpoint_path = parts_dir / "checkpoint.json"
+        checkpoint = self._load_checkpoint(checkpoint_path, build_settings())
+        if checkpoint["next_record"]:
+            self._log(f"Resuming from event {checkpoint['next_record']} of {self.n_records}")
+
+        chunks = self.iter_chunks(chunk_size, workers=workers, start=checkpoint["next_record"],
+                                  waveforms=waveform_encodings(types))
+        exhausted = False
+        while not exhausted:
+            n_part_events = 0
+
+            def part_chunks():
+                nonlocal exhausted, n_part_events
+                while n_part_events < checkpoint_events:
+                    tables = next(chunks, None)
+                    if tables is None:
+                        exhausted = True
+                        return
+                    n_part_events += len(next(iter(tables.values()))) if tables else 0
+                    yield tables
+
+            part = parts_dir / f"part-{len(checkpoint['parts']):05d}"
+            writers = [writer_type(self, part.with_suffix(writer_type.suffix), partial=True) for writer_type in types]
+            self._write(writers, part_chunks())
+            if not n_part_events:
+                for writer in writers:
+                    writer.abort()
+                break
+            for writer in writers:
+                writer.commit()
 
-        for key, val in events.items():
-            events[key] = np.array(val)
+            checkpoint["parts"].append({"name": part.name,
+                                        "files": [path.name for writer in writers for path in writer.outputs()]})
+            checkpoint["next_record"] += n_part_events
+            checkpoint["offset"] = self._event_offset + checkpoint["next_record"] * self._record_dtype.itemsize
+            with atomic_open(checkpoint_path) as checkpoint_file:
+                json.dump(checkpoint, checkpoint_file)
 
-        root_file['Events'] = events
-        root_file.close()
+        merged = []
+        try:
+            for writer_type in types:
+                part_paths = [(parts_dir / part["name"]).with_suffix(writer_type.suffix)
+                              for part in checkpoint["parts"]]
+                merged.append(writer_type.merge(self, part_paths, output_path.with_suffix(writer_type.suffix),
+                                                chunk_size))
+        except BaseException:
+            for writer in merged:
+                writer.abort()
+            raise
+        commit_all(merged)
+        shutil.rmtree(parts_dir)
+
+    INDEX_DTYPE = np.dtype([
+        ("offset", "<u8"),  # byte offset of the event record in the file
+        ("id", "<u4"),
+        ("timestamp", "<f8"),
+        ("board", "<u2"),
+        ("channels", "<u2"),  # bit n is set if channel n is present
+    ])
+
+    @property
+    def index_path(self):
+        return Path(self.path).with_suffix(".idx.npz")
+
+    def build_index(self, chunk_size=100_000):
+        """
+        One pass over the event headers, writing the offset, serial number, timestamp, board and channels of every
+        event to a sidecar file next to the raw file. Returns the index.
+        """
+        records = self._records()
+        index = []
+        for start in range(0, len(records), chunk_size):
+            chunk = records[start:start+chunk_size]
+            checked = self._check_records(chunk)
+            entries = np.zeros(len(checked), dtype=self.INDEX_DTYPE)
+            entries["offset"] = self._event_offset + (start + np.arange(len(checked))) * self._record_dtype.itemsize
+            entries["id"] = checked["serial_number"]
+            entries["timestamp"] = _local_timestamps(checked)
+            entries["board"] = checked["board"]
+            channel_numbers = checked["channels"]["channel"].astype(np.int64)
+            entries["channels"] = np.bitwise_or.reduce(1 << channel_numbers, axis=1) if channel_numbers.size else 0
+            index.append(entries)
+            if len(checked) < len(chunk):
+                break
+        index = np.concatenate(index) if index else np.zeros(0, dtype=self.INDEX_DTYPE)
+
+        stat = os.stat(self.path)
+        with open(self.index_path, "wb") as index_file:
+            np.savez(index_file, events=index, source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns)
+        self._index = index
+        return index
+
+    def load_index(self):
+        """
+        Loads the sidecar index, building it first if it is missing or older than the raw file.
+        """
+        if self._index is not None:
+            return self._index
+        stat = os.stat(self.path)
+        try:
+            with np.load(self.index_path) as sidecar:
+                if sidecar["source_size"] == stat.st_size and sidecar["source_mtime_ns"] == stat.st_mtime_ns:
+                    self._index = sidecar["events"]
+                    return self._index
+        except (OSError, KeyError, ValueError):
+            pass
+        return self.build_index()
+
+    def read_events(self, entries, process=True):
+        """
+        Reads the events at the given entry numbers straight from the raw file, seeking to each one through the
+        index. Returns one EventTable per (board, channel), in the order of `entries`, with features filled in
+        if `process` is set.
+        """
+        index = self.load_index()
+        offsets = index["offset"][np.atleast_1d(entries)]
+        with open(self.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            records = np.concatenate([
+                np.frombuffer(data, dtype=self._record_dtype, count=1, offset=int(offset)) for offset in offsets
+            ]) if len(offsets) else np.zeros(0, dtype=self._record_dtype)
+        tables = self._decode(self._check_records(records))
+        if process:
+            for table in tables.values():
+                table.columns.update(extract_features(table.waveform, table.times, self.EDGE_PEAK_KEEP_OUT,
+                                                      backend=the_config.FEATURE_BACKEND))
+        return tables
+
+    def read_event(self, entry, process=True):
+        """
+        Reads a single event, returning an Event view for each (board, channel) it was recorded on.
+        """
+        return {channel: table[0] for channel, table in self.read_events([entry], process=process).items()}
+
+
+def _process_chunk_worker(path, start, stop, waveforms):
+    drs = DRSDatFile(path, load=False, verbose=False)
+    tables, complete = drs._process_chunk(start, stop)
+    drs._drop_waveforms(tables, waveforms)
+    return tables, complete, drs.stats.stages
+
+
+def convert_file(dat_file_path, root_file_path, verbose=True, workers=1, stats=None):
+    """
+    Converts one file to each of `OUTPUT_FORMATS`, named like `root_file_path` with the suffix of the format.
+    Stage timings are gathered in `stats` if given. Returns the file's `source_stamp`, hashed during the conversion.
+    """
+    root_file_path.parent.mkdir(parents=True, exist_ok=True)
+    if verbose:
+        print(f"Processing file: {dat_file_path}")
+    drs = DRSDatFile(dat_file_path, load=False, verbose=verbose)
+    if stats is not None:
+        drs.stats = stats
+    drs.convert(root_file_path, workers=workers)
+    return drs.source_stamp()
+
+
+def _convert_worker(dat_file_path, root_file_path, verbose=False, workers=1):
+    """
+    Runs `convert_file`, which also stamps the source file. Pool workers run quietly so their progress lines don't
+    interleave. Errors are returned as formatted tracebacks so the batch carries on. With `PROFILE` set, a cProfile of
+    the conversion is saved next to the output (covering this process only, not the workers a split file is sent to).
+
+    Returns (stamp, error, file_stats), with `file_stats` the timings and throughput of the file for the run summary.
+    """
+    stats = StageStats()
+    n_bytes = os.path.getsize(dat_file_path)
+    start = time.perf_counter()
+    stamp = error = None
+    try:
+        with profiled(root_file_path.with_suffix(".prof") if the_config.PROFILE else None):
+            stamp = convert_file(dat_file_path, root_file_path, verbose=verbose, workers=workers, stats=stats)
+    except Exception:
+        error = traceback.format_exc()
+    seconds = time.perf_counter() - start
+    n_events = stats.stages.get("decode", {}).get("events", 0)
+    file_stats = {
+        "file": str(dat_file_path),
+        "status": "failed" if error else "processed",
+        "seconds": seconds,
+        "events": n_events,
+        "bytes": n_bytes,
+        "events_per_second": n_events / seconds if seconds else None,
+        "mb_per_second": n_bytes / 1e6 / seconds if seconds else None,
+        "process_peak_rss": peak_rss(),  # of the process that converted the file, up to the end of the conversion
+        "stages": stats.summary(),
+    }
+    return stamp if error is None else None, error, file_stats
+
+
+def _run_conversions(pending):
+    """
+    Converts each (dat_file_path, root_file_path) pair, yielding (dat_file_path, stamp, error, file_stats) as each one
+    finishes.
+    Files are sent to a pool of `WORKERS` processes when there are enough of them to keep it busy. Otherwise, with
+    `SPLIT_FILES`, they are converted one at a time with each file's events split across the workers.
+    """
+    if the_config.WORKERS > 1 and (len(pending) >= the_config.WORKERS or not the_config.SPLIT_FILES):
+        with ProcessPoolExecutor(max_workers=min(the_config.WORKERS, len(pending))) as pool:
+            futures = {pool.submit(_convert_worker, dat_file_path, root_file_path): dat_file_path
+                       for dat_file_path, root_file_path in pending}
+            for future in as_completed(futures):
+                yield (futures[future], *future.result())
+    else:
+        workers = the_config.WORKERS if the_config.SPLIT_FILES else 1
+        for dat_file_path, root_file_path in pending:
+            yield (dat_file_path, *_convert_worker(dat_file_path, root_file_path, verbose=True, workers=workers))
+
+
+def code_version():
+    """
+    Hash of the code that determines the contents of processed files.
+    """
+    sha = hashlib.sha256()
+    for module in PROCESSING_CODE:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), module), "rb") as source:
+            sha.update(source.read())
+    return sha.hexdigest()
+
+
+def build_settings():
+    """
+    Everything besides the source file that a processed file depends on. Outputs built with different settings are
+    rebuilt.
+    """
+    return {"code_version": code_version(), **{name: getattr(the_config, name) for name in OUTPUT_SETTINGS}}
+
+
+def write_run_summary(path, started, seconds, n_skipped, file_stats):
+    """
+    Writes a JSON summary of a `process_all` run: the stats of each file converted and the totals for each stage.
+    """
+    totals = StageStats()
+    for stats in file_stats:
+        totals.merge(stats["stages"])
+    n_events = sum(stats["events"] for stats in file_stats)
+    n_bytes = sum(stats["bytes"] for stats in file_stats)
+    summary = {
+        "started": started.isoformat(),
+        "seconds": seconds,
+        "workers": the_config.WORKERS,
+        "files_processed": sum(stats["status"] == "processed" for stats in file_stats),
+        "files_failed": sum(stats["status"] == "failed" for stats in file_stats),
+        "files_skipped": n_skipped,
+        "events": n_events,
+        "bytes": n_bytes,
+        "events_per_second": n_events / seconds if seconds else None,
+        "mb_per_second": n_bytes / 1e6 / seconds if seconds else None,
+        "process_peak_rss": max((stats["process_peak_rss"] or 0 for stats in file_stats), default=None),
+        "stages": totals.summary(),
+        "files": file_stats,
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_open(path) as summary_file:
+        json.dump(summary, summary_file, indent=2)
+
+
+def remove_live_snapshot(root_file_path):
+    """
+    Removes the snapshot monitor.py left next to `root_file_path` while the run was being recorded, once the
+    processed file is newer than it, so the report stops showing the run as live.
+    """
+    snapshot_path = root_file_path.with_suffix(".live.npz")
+    try:
+        if os.path.getmtime(root_file_path) >= os.path.getmtime(snapshot_path):
+            snapshot_path.unlink()
+    except FileNotFoundError:
+        pass
 
 
 def process_all():
+    started = datetime.now()
+    start = time.perf_counter()
+    # Fail here, once, rather than on every file if the backend can't be used (say "numba" without numba installed)
+    pulse_bounds_backend(the_config.FEATURE_BACKEND)
     found_paths, blacklisted_paths = the_config.get_dat_files()
+    manifest = BuildManifest(Path(the_config.PROCESSED_DATA_ROOT) / "manifest.json")
+    settings = build_settings()
+    # The log only ever describes the latest run, so one left by an earlier run mustn't outlive this one
+    log_path = Path(the_config.PROCESSED_DATA_ROOT) / "failed_files.log"
+    log_path.unlink(missing_ok=True)
+    pending = []
     for (idx, dat_file_path) in enumerate(found_paths):
         relative_path = dat_file_path.relative_to(the_config.RAW_DATA_ROOT)
         root_file_path = (Path(the_config.PROCESSED_DATA_ROOT) / relative_path).with_suffix(".root")
+        output_paths = [root_file_path.with_suffix(writer_type.suffix)
+                        for writer_type in writer_types(the_config.OUTPUT_FORMATS)]
 
-        if the_config.RECREATE or not root_file_path.is_file():
-            print(f"Processing file       ({idx+1}/{len(found_paths)}): "
-                  f"{dat_file_path.relative_to(the_config.RAW_DATA_ROOT)}")
-            root_file_path.parent.mkdir(parents=True, exist_ok=True)
-            drs = DRSDatFile(dat_file_path)
-            drs.to_root(root_file_path)
+        if the_config.RECREATE or any(manifest.is_stale(relative_path.as_posix(), dat_file_path, output_path, settings)
+                                      for output_path in output_paths):
+            pending.append((dat_file_path, root_file_path))
+        else:
+            print(f"Up to date, Skipping  ({idx+1}/{len(found_paths)}): {dat_file_path.name}")
+
+    failures = {}
+    file_stats = []
+    for idx, (dat_file_path, stamp, error, stats) in enumerate(_run_conversions(pending)):
+        relative_path = dat_file_path.relative_to(the_config.RAW_DATA_ROOT)
+        file_stats.append(stats)
+        if error is None:
+            print(f"Processed file        ({idx+1}/{len(pending)}): {relative_path} "
+                  f"({stats['seconds']:.1f} s, {stats['events_per_second']:.0f} events/s, "
+                  f"{stats['mb_per_second']:.1f} MB/s)")
+            manifest.record(relative_path.as_posix(), stamp, settings)
+            manifest.save()
+            remove_live_snapshot((Path(the_config.PROCESSED_DATA_ROOT) / relative_path).with_suffix(".root"))
         else:
-            print(f"File exists, Skipping ({idx+1}/{len(found_paths)}): {dat_file_path.name}")
+            print(f"Failed to process     ({idx+1}/{len(pending)}): {relative_path}")
+            failures[dat_file_path] = error
+    manifest.save()
+    write_run_summary(Path(the_config.PROCESSED_DATA_ROOT) / "run_summary.json", started,
+                      time.perf_counter() - start, len(found_paths) - len(pending), file_stats)
+
+    if failures:
+        with open(log_path, "w") as log:
+            for dat_file_path, error in failures.items():
+                log.write(f"{dat_file_path}\n{error}\n")
+        print(f"{len(failures)} file(s) failed to process, see {log_path}")
+    return failures
 
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+import numpy as np
+
+from config import the_config
+from data import read_events
+from summary import summary_cache
+
+
+def binned_trigger_rate(timestamps, scaler, resolution_seconds=20):
+    """
+    Mean scaler value in consecutive `resolution_seconds` bins, measured from the earliest timestamp. Bin n covers
+    ((n-1)*resolution_seconds, n*resolution_seconds] after the start (the first bin includes the start itself).
+    Empty bins are left out, as is the final bin since it is usually only partly filled.
+
+    Returns (bin_times, mean_scaler, start), with `bin_times` the bin centers in seconds after `start`.
+    """
+    if not len(timestamps):
+        return np.zeros(0), np.zeros(0), None
+    order = np.argsort(timestamps, kind="stable")
+    timestamps = np.asarray(timestamps)[order]
+    scaler = np.asarray(scaler)[order]
+    timestamps_rel = timestamps - timestamps[0]
+
+    n_edges = int(np.ceil(timestamps_rel[-1] / resolution_seconds)) + 1
+    edges = np.arange(1, n_edges + 1) * resolution_seconds
+    bin_idx = np.searchsorted(edges, timestamps_rel, side="left")
+
+    n_bins = bin_idx[-1]  # drop the final, partial bin
+    counts = np.bincount(bin_idx, minlength=n_bins + 1)[:n_bins]
+    sums = np.bincount(bin_idx, weights=scaler, minlength=n_bins + 1)[:n_bins]
+    filled = counts > 0
+    bin_times = (np.nonzero(filled)[0] + 0.5) * resolution_seconds
+    return bin_times, sums[filled] / counts[filled], timestamps[0]
+
+
+def sample_trigger_rate(path, resolution_seconds=20, read=read_events):
+    """
+    `binned_trigger_rate` for one processed file, cached alongside the file's other summaries.
+    """
+    def compute():
+        data = read(path, ['timestamp', 'scaler'])
+        bin_times, mean_scaler, start = binned_trigger_rate(data['timestamp'], data['scaler'], resolution_seconds)
+        return {
+            "bin_times": bin_times,
+            "mean_scaler": mean_scaler,
+            "start": np.array(np.nan if start is None else start),
+        }
+    result = summary_cache().get(path, ("trigger_rate", float(resolution_seconds)), compute)
+    return result["bin_times"], result["mean_scaler"], float(result["start"])
+
+
+def all_trigger_rates(resolution_seconds=20, **sample_filters):
+    """
+    `sample_trigger_rate` for every processed sample matching `sample_filters` (as for `Config.find_samples`), keyed
+    by sample id. Useful for run-quality monitoring across all PMTs.
+    """
+    sample_ids, paths = the_config.find_samples(**sample_filters)
+    return {sample_id: sample_trigger_rate(path, resolution_seconds) for sample_id, path in zip(sample_ids, paths)}
+
+
+class RateAccumulator:
+    """
+    RateAccumulator: Incremental form of `binned_trigger_rate` for events that arrive in blocks, such as while a run
+    is still being recorded. Bins are measured from the first timestamp seen, and each block costs time proportional
+    to its own size.
+    """
+
+    def __init__(self, resolution_seconds=20):
+        self.resolution_seconds = resolution_seconds
+        self.start = None
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros(0, dtype=np.float64)
+
+    def add(self, timestamps, scaler):
+        if not len(timestamps):
+            return
+        if self.start is None:
+            self.start = np.min(timestamps)
+        bin_idx = np.maximum(np.ceil((timestamps - self.start) / self.resolution_seconds).astype(np.int64) - 1, 0)
+        n_bins = max(len(self.counts), bin_idx.max() + 1)
+        self.counts = np.bincount(bin_idx, minlength=n_bins) + np.pad(self.counts, (0, n_bins - len(self.counts)))
+        self.sums = (np.bincount(bin_idx, weights=scaler, minlength=n_bins) +
+                     np.pad(self.sums, (0, n_bins - len(self.sums))))
+
+    def result(self):
+        """
+        (bin_times, mean_scaler, start), as returned by `binned_trigger_rate`.
+        """
+        counts = self.counts[:-1]  # drop the final, partial bin
+        filled = counts > 0
+        bin_times = (np.nonzero(filled)[0] + 0.5) * self.resolution_seconds
+        return bin_times, self.sums[:-1][filled] / counts[filled], self.start
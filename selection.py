@@ -0,0 +1,74 @@
+import numpy as np
+
+from config import the_config
+
+# Bits of the "selection" column, one per reason an event's waveform was kept
+SELECTION_FLAGS = {
+    "area": 1,
+    "width": 2,
+    "saturated": 4,
+    "pileup": 8,
+    "prescale": 16,
+}
+
+ADC_MAX = 65535
+PILEUP_NOISE_MULTIPLE = 5  # A second pulse must also stand this far above the pre-pulse noise
+
+
+def _outside(values, range_):
+    if not range_:
+        return np.zeros(len(values), dtype=bool)
+    low, high = range_
+    return (values < low) | (values > high)
+
+
+def prescaled(ids, prescale):
+    """
+    Whether each event is in the pseudo-random 1 in `prescale` sample. The choice is a hash of the event id, so the
+    same events are picked however the file is split into chunks or workers.
+    """
+    if prescale <= 0:
+        return np.zeros(len(ids), dtype=bool)
+    hashed = (ids.astype(np.uint64) * np.uint64(2654435761)) % np.uint64(2**32)
+    return (hashed >> np.uint64(16)) % np.uint64(prescale) == 0
+
+
+def pileup(waveform, times, peak_t, peak_v, width, noise, fraction):
+    """
+    Whether each processed waveform rises above `fraction` of its peak (and well above its noise) anywhere outside
+    the main pulse, taken as the samples within `width` of the peak.
+    """
+    if fraction <= 0:
+        return np.zeros(len(waveform), dtype=bool)
+    outside = np.abs(times[None, :] - peak_t[:, None]) > width[:, None]
+    second = np.where(outside, waveform, -np.inf).max(axis=1, initial=-np.inf)
+    return (second > fraction * peak_v) & (second > PILEUP_NOISE_MULTIPLE * noise)
+
+
+def selection_flags(table):
+    """
+    The `SELECTION_FLAGS` of each event of one EventTable, whose features must already be filled in, under the
+    `SELECT_*` config fields.
+    """
+    columns = table.columns
+    flags = np.zeros(len(table), dtype=np.uint8)
+    flags[_outside(columns["area"], the_config.SELECT_AREA)] |= SELECTION_FLAGS["area"]
+    flags[_outside(columns["width"], the_config.SELECT_WIDTH)] |= SELECTION_FLAGS["width"]
+    if the_config.SELECT_SATURATED and table.adc is not None and table.adc.size:
+        saturated = (table.adc.min(axis=1) == 0) | (table.adc.max(axis=1) == ADC_MAX)
+        flags[saturated] |= SELECTION_FLAGS["saturated"]
+    flags[pileup(table.waveform, table.times, columns["peak_t"], columns["peak_v"], columns["width"],
+                 columns["noise"], the_config.SELECT_PILEUP_FRACTION)] |= SELECTION_FLAGS["pileup"]
+    flags[prescaled(columns["id"], the_config.SELECT_PRESCALE)] |= SELECTION_FLAGS["prescale"]
+    return flags
+
+
+def selected_events(tables):
+    """
+    Whether each event of a chunk of EventTables (one per channel, as from `DRSDatFile.iter_chunks`) was selected on
+    any of its channels.
+    """
+    tables = list(tables)
+    if not tables:
+        return np.zeros(0, dtype=bool)
+    return np.bitwise_or.reduce([table.columns["selection"] for table in tables]) != 0
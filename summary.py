@@ -0,0 +1,147 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import numpy as np
+
+from atomic import atomic_open
+from config import the_config
+from data import read_events, sample_data
+
+QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+
+
+class SummaryCache:
+    """
+    SummaryCache: Stores small per-sample results (statistics, histograms) under CACHE_DIR, keyed by the content hash
+    of the processed file they were computed from. A result is computed once and then served from the cache until
+    the file's contents change.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir) / "summaries"
+
+    @staticmethod
+    def _write_atomic(path, write):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_open(path, "wb", unique=True) as file:
+            write(file)
+
+    def content_hash(self, path):
+        """
+        SHA-256 of the file at `path`. It is remembered alongside the file's size and mtime, so each version of a
+        file is only hashed once.
+        """
+        from manifest import file_hash
+        stat = os.stat(path)
+        path_key = hashlib.sha256(str(Path(path).resolve()).encode("utf-8")).hexdigest()
+        memo_path = self.cache_dir / "hashes" / f"{path_key}.json"
+        try:
+            with open(memo_path) as memo_file:
+                memo = json.load(memo_file)
+            if memo["size"] == stat.st_size and memo["mtime_ns"] == stat.st_mtime_ns:
+                return memo["sha256"]
+        except (OSError, ValueError, KeyError):
+            pass
+        memo = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_hash(path)}
+        self._write_atomic(memo_path, lambda memo_file: memo_file.write(json.dumps(memo).encode("utf-8")))
+        return memo["sha256"]
+
+    def get(self, path, item, compute):
+        """
+        The cached result identified by `item` (any repr-able description of what was computed) for the file at
+        `path`, calling `compute` to produce a dict of arrays on a cache miss.
+        """
+        item_key = hashlib.sha256(repr(item).encode("utf-8")).hexdigest()
+        cache_path = self.cache_dir / self.content_hash(path) / f"{item_key}.npz"
+        try:
+            with np.load(cache_path) as cached:
+                return {key: cached[key] for key in cached.files}
+        except (OSError, ValueError):
+            pass
+        result = compute()
+        self._write_atomic(cache_path, lambda cache_file: np.savez(cache_file, **result))
+        return result
+
+
+_summary_cache = None
+
+
+def summary_cache():
+    global _summary_cache
+    if _summary_cache is None:
+        _summary_cache = SummaryCache(the_config.CACHE_DIR)
+    return _summary_cache
+
+
+def branch_summary(path, branch, read=read_events):
+    """
+    Entry count, moments, extrema, first/last values and `QUANTILES` of one branch.
+    """
+    def compute():
+        data = read(path, [branch])[branch]
+        if not len(data):
+            return {"count": np.array(0)}
+        return {
+            "count": np.array(len(data)),
+            "mean": np.mean(data),
+            "std": np.std(data),
+            "min": np.min(data),
+            "max": np.max(data),
+            "first": data[0],
+            "last": data[-1],
+            "quantiles": np.quantile(data, QUANTILES),
+        }
+    return summary_cache().get(path, ("summary", branch), compute)
+
+
+def histogram(path, branch, n_bins, range_=None, read=read_events):
+    """
+    Fixed-binning histogram of one branch, returned as (counts, edges). Without a `range_`, the branch's extrema are
+    used, as `plt.hist` would.
+    """
+    if range_ is None:
+        stats = branch_summary(path, branch, read=read)
+        range_ = (float(stats["min"]), float(stats["max"])) if stats["count"] else (0.0, 1.0)
+    range_ = tuple(float(edge) for edge in range_)
+
+    def compute():
+        counts, edges = np.histogram(read(path, [branch])[branch], bins=n_bins, range=range_)
+        return {"counts": counts, "edges": edges}
+    result = summary_cache().get(path, ("histogram", branch, n_bins, range_), compute)
+    return result["counts"], result["edges"]
+
+
+def histogram_2d(path, branch_x, branch_y, n_bins, range_, read=read_events):
+    """
+    Fixed-binning 2-D histogram of two branches, returned as (counts, x_edges, y_edges).
+    """
+    range_ = tuple(tuple(float(edge) for edge in axis_range) for axis_range in range_)
+
+    def compute():
+        data = read(path, [branch_x, branch_y])
+        counts, x_edges, y_edges = np.histogram2d(data[branch_x], data[branch_y], bins=n_bins, range=range_)
+        return {"counts": counts, "x_edges": x_edges, "y_edges": y_edges}
+    result = summary_cache().get(path, ("histogram_2d", branch_x, branch_y, n_bins, range_), compute)
+    return result["counts"], result["x_edges"], result["y_edges"]
+
+
+def violin_stats(path, branch, sample_start=0.0, points=100, read=read_events):
+    """
+    The kernel density estimate `plt.violinplot` would draw for the entries of one branch from `sample_start` (a
+    fraction of the sample) onwards, in the form taken by `plt.violin`. Only those entries are read.
+    """
+    def compute():
+        from matplotlib.cbook import violin_stats as mpl_violin_stats
+        from matplotlib.mlab import GaussianKDE
+        entry_start = int(sample_start*sample_data(path).num_entries)
+        data = read(path, [branch], entry_start=entry_start)[branch]
+
+        def kde(x, coords):
+            # Same estimate as plt.violinplot, including its special case for constant data
+            if np.all(x[0] == x):
+                return (x[0] == coords).astype(float)
+            return GaussianKDE(x).evaluate(coords)
+        stats, = mpl_violin_stats([data], kde, points=points)
+        return {key: np.asarray(value) for key, value in stats.items()}
+    return summary_cache().get(path, ("violin", branch, sample_start, points), compute)
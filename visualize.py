@@ -1,21 +1,43 @@
+from functools import wraps
 import numpy as np
 from datetime import date
-import matplotlib.pyplot as plt
-from matplotboard import decl_fig, render, generate_report, configure, serve
 from os.path import realpath
+from pathlib import Path
 from config import the_config
+from data import sample_data
+import rates
+import summary
 
+# matplotlib and matplotboard are imported by the functions that use them, so that importing this module (say, for
+# `load_data` or the sample catalog) doesn't pay for them
 
-def decorate(sample_id):
+
+def decl_fig(fn):
+    """
+    matplotboard's `decl_fig`, imported when a figure is first declared.
+    """
+    @wraps(fn)
+    def declare(*args, **kwargs):
+        from matplotboard import decl_fig as matplotboard_decl_fig
+        return matplotboard_decl_fig(fn)(*args, **kwargs)
+    return declare
+
+
+def sample_path(sample):
     from matplotboard import d
+    return d[sample].file_path
+
+
+def decorate(sample_id):
+    import matplotlib.pyplot as plt
     pmt_id, date_, voltage, signal = sample_id
-    ts = d[sample_id]['timestamp'].array()
-    duration = (ts[-1] - ts[0]) / 60
+    ts = summary.branch_summary(sample_path(sample_id), 'timestamp')
+    duration = (ts['last'] - ts['first']) / 60 if ts['count'] else 0.0
     text = (
         f"PMT ID: {pmt_id}\n"
         f"Date: {date_}\n"
         f"Duration: {duration:.2f} mins\n"
-        f"Pulse Count: {len(ts)}\n"
+        f"Pulse Count: {ts['count']}\n"
         f"Bias: {voltage} V\n"
         f"Signal: {signal}"
         )
@@ -25,21 +47,64 @@ def decorate(sample_id):
              bbox=dict(facecolor='white', alpha=0.9, linewidth=2.0))
 
 
+def channel_times(sample, board, channel):
+    """
+    Time axis of one channel. It is stored once per channel in the Calibration tree, next to the Events tree.
+    """
+    from matplotboard import d
+    calibration = d[sample].arrays(['board', 'channel', 'times'], tree='Calibration')
+    match = (calibration['board'] == board) & (calibration['channel'] == channel)
+    if not match.any():
+        raise KeyError(f"No calibration for board {board}, channel {channel} in sample {sample}")
+    return calibration['times'][np.argmax(match)]
+
+
+def event_waveforms(sample, entry_start=None, entry_stop=None):
+    """
+    Waveforms of a sample in volts. Files written with `WAVEFORM_ENCODING = "adc"` store raw samples, which are
+    converted here. Files written with `WAVEFORM_SELECTION` only hold the waveforms of the selected events, in the
+    Waveforms tree, so only those within the range of entries are returned.
+    """
+    from matplotboard import d
+    from process import adc_to_volts
+    sample_data = d[sample]
+    tree = 'Events'
+    keys = sample_data.keys()
+    if 'waveform' not in keys and 'waveform_adc' not in keys:
+        tree = 'Waveforms'
+        keys = sample_data.keys(tree)
+        entries = sample_data.arrays(['entry'], tree=tree)['entry']
+        entry_start = 0 if entry_start is None else int(np.searchsorted(entries, entry_start))
+        entry_stop = len(entries) if entry_stop is None else int(np.searchsorted(entries, entry_stop))
+    if 'waveform_adc' in keys:
+        branches = sample_data.arrays(['waveform_adc', 'range_center', 'polarity'], entry_start, entry_stop, tree=tree)
+        return adc_to_volts(branches['waveform_adc'], branches['range_center'], branches['polarity'])
+    return sample_data.arrays(['waveform'], entry_start, entry_stop, tree=tree)['waveform']
+
+
 @decl_fig
 def simple_waveform(sample, board, channel, id_):
+    import matplotlib.pyplot as plt
     from matplotboard import d
-    waveform = d[sample]['waveform'].array()[id_]
-    times = d[sample]['times'].array()[id_]
-    plt.plot(times, waveform)
+    entry = d[sample].arrays(['board', 'channel'], id_, id_+1)
+    if (entry['board'][0], entry['channel'][0]) != (board, channel):
+        raise ValueError(f"Entry {id_} of sample {sample} is board {entry['board'][0]}, channel "
+                         f"{entry['channel'][0]}, not board {board}, channel {channel}")
+    waveforms = event_waveforms(sample, id_, id_+1)
+    if not len(waveforms):
+        # Files written with WAVEFORM_SELECTION only keep the waveforms of selected events
+        plt.text(0.5, 0.5, f"Waveform of entry {id_} was not kept", ha='center', va='center',
+                 transform=plt.gca().transAxes)
+        return
+    times = channel_times(sample, board, channel)
+    plt.plot(times, waveforms[0])
 
 
 @decl_fig
 def histogram(sample, key, n_bins=100, range_=None, x_label="", title=""):
-    from matplotboard import d
-    data = d[sample][key].array()
-    if range_ is None:
-        range_ = (np.min(data), np.max(data))
-    plt.hist(data, bins=n_bins, range=range_)
+    import matplotlib.pyplot as plt
+    counts, edges = summary.histogram(sample_path(sample), key, n_bins, range_)
+    plt.hist(edges[:-1], bins=edges, weights=counts)
     plt.xlabel(x_label)
     plt.title(title)
     decorate(sample)
@@ -47,20 +112,18 @@ def histogram(sample, key, n_bins=100, range_=None, x_label="", title=""):
 
 @decl_fig
 def histogram_2d(sample, key_x, key_y, n_bins=(100, 100), range_=None, x_label="", y_label="", title=""):
-    from matplotboard import d
-    # from matplotlib.colors import
-    data_x = d[sample][key_x].array()
-    data_y = d[sample][key_y].array()
-    if range_ is None or range_[0] is None:
-        range_x = (np.min(data_x), np.max(data_x))
-    else:
-        range_x = range_[0]
-    if range_ is None or range_[1] is None:
-        range_y = (np.min(data_y), np.max(data_y))
-    else:
-        range_y = range_[1]
+    import matplotlib.pyplot as plt
+    path = sample_path(sample)
+    ranges = []
+    for axis, key in enumerate((key_x, key_y)):
+        if range_ is None or range_[axis] is None:
+            stats = summary.branch_summary(path, key)
+            ranges.append((stats['min'], stats['max']))
+        else:
+            ranges.append(range_[axis])
 
-    plt.hist2d(data_x, data_y, bins=n_bins, range=(range_x, range_y), cmin=1)
+    counts, x_edges, y_edges = summary.histogram_2d(path, key_x, key_y, n_bins, ranges)
+    plt.pcolormesh(x_edges, y_edges, np.ma.masked_less(counts, 1).T)
     plt.colorbar()
     plt.xlabel(x_label)
     plt.ylabel(y_label)
@@ -70,26 +133,30 @@ def histogram_2d(sample, key_x, key_y, n_bins=(100, 100), range_=None, x_label="
 
 @decl_fig
 def correlation_v_bias(pmt_id, key):
-    from matplotboard import d
-    samples_ = [sample for sample in d if sample[0] == pmt_id]
-    avgs = []
-    stds = []
-    biases = []
-    for sample in samples_:
-        data = d[sample][key].array()
-        avgs.append(np.mean(data))
-        stds.append(np.std(data))
-        biases.append(sample[2])
-    plt.errorbar(biases, avgs, yerr=stds)
+    """
+    Mean and spread of `key` in each sample of one PMT, from a single scan of that PMT's samples in the feature
+    dataset. Without pyarrow, each sample's summary is read from its ROOT file instead.
+    """
+    import matplotlib.pyplot as plt
+    from dataset import pyarrow_available, scan_features
+    if not pyarrow_available():
+        sample_ids, paths = the_config.find_samples(pmt_id=pmt_id)
+        stats = [summary.branch_summary(path, key) for path in paths]
+        plt.errorbar([sample_id[2] for sample_id in sample_ids], [stat['mean'] for stat in stats],
+                     yerr=[stat['std'] for stat in stats])
+        return
+    table = scan_features([key, 'date', 'voltage', 'signal'], pmt_id=pmt_id)
+    stats = table.group_by(['date', 'voltage', 'signal']).aggregate([(key, 'mean'), (key, 'stddev')]).to_pylist()
+    stats.sort(key=lambda row: (row['date'], row['voltage'], row['signal']))
+    plt.errorbar([row['voltage'] for row in stats], [row[f'{key}_mean'] for row in stats],
+                 yerr=[row[f'{key}_stddev'] for row in stats])
 
 
 @decl_fig
-def trigger_rate_vs_time(pmt_ids):
-    from matplotboard import d
-    from matplotlib.dates import DateFormatter
+def trigger_rate_vs_time(pmt_ids, resolution_seconds=20):
+    import matplotlib.pyplot as plt
     from matplotlib.ticker import AutoMinorLocator
     import matplotlib.colors as mcolors
-    from datetime import datetime
     from random import shuffle
 
     samples = []
@@ -102,44 +169,9 @@ def trigger_rate_vs_time(pmt_ids):
         colors = list(mcolors.XKCD_COLORS.values())
         shuffle(colors)
     for sample, color in zip(samples, colors):
-        scaler = d[sample]['scaler'].array()
-        timestamps = d[sample]['timestamp'].array()
-
-        mono_idxs = np.argsort(timestamps)
-        scaler = scaler[mono_idxs]
-        timestamps = timestamps[mono_idxs]
-
-        # in_order = 0
-        # out_order = 0
-        # for idx1, idx2 in zip(mono_idxs[:-1], mono_idxs[1:]):
-        #     if idx2 > idx1:
-        #         in_order += 1
-        #     else:
-        #         out_order += 1
-        # print(f"{out_order}/{in_order+out_order} ({100*out_order/(out_order+in_order):.2f}%) out of order")
-
-        timestamps_rel = timestamps - timestamps[0]
-
-        resolution_seconds = 20
-        scaler_avgs = []
-        avg_times = []
-        n = 0
-
-        prev_idx = 0
-        while True:
-            n += 1
-            cut_idx = np.argmax(timestamps_rel > n*resolution_seconds)
-            if cut_idx == 0:
-                break
-            elif cut_idx == prev_idx:
-                continue
-
-            scaler_avgs.append(np.mean(scaler[prev_idx:cut_idx]))
-            avg_times.append((n-.5)*resolution_seconds)
-            prev_idx = cut_idx
-        if scaler_avgs:
-            datetimes = [datetime.fromtimestamp(ts+timestamps[0]) for ts in avg_times]
-            plt.semilogy(np.array(avg_times)/60, scaler_avgs, label=str(sample), color=color)
+        avg_times, scaler_avgs, _ = rates.sample_trigger_rate(sample_path(sample), resolution_seconds)
+        if len(scaler_avgs):
+            plt.semilogy(avg_times/60, scaler_avgs, label=str(sample), color=color)
             plt.ylim((1, 10_000))
             plt.minorticks_on()
             plt.grid(visible=True, axis="both", which='minor', linestyle="--", alpha=0.4)
@@ -152,39 +184,114 @@ def trigger_rate_vs_time(pmt_ids):
 
 @decl_fig
 def observable_comparison(pmt_ids, key, sample_start=0.5, range_=None):
-    from matplotboard import d
-
-    all_data = []
+    import matplotlib.pyplot as plt
+    all_stats = []
     labels = []
     for pmt_id in pmt_ids:
         sample_id = the_config.find_samples(pmt_id=pmt_id)[0][0]
-        sample_data = d[sample_id][key].array()
-        sample_data = sample_data[int(sample_start*len(sample_data)):]
-        all_data.append(sample_data)
+        all_stats.append(summary.violin_stats(sample_path(sample_id), key, sample_start=sample_start, points=200))
         labels.append(pmt_id)
-    labels, all_data = zip(*sorted(zip(labels, all_data)))
-    plt.violinplot(all_data,
-                   showextrema=False,
-                   showmeans=True,
-                   points=200,
-                   vert=False)
-    plt.yticks([x+1 for x in range(len(all_data))], labels)
+    labels, all_stats = zip(*sorted(zip(labels, all_stats), key=lambda label_stats: label_stats[0]))
+    plt.gca().violin(all_stats,
+                     positions=[x+1 for x in range(len(all_stats))],
+                     showextrema=False,
+                     showmeans=True,
+                     vert=False)
+    plt.yticks([x+1 for x in range(len(all_stats))], labels)
     if range_ is not None:
         plt.xlim(range_)
 
 
+@decl_fig
+def live_monitor(snapshot_path):
+    """
+    Running histograms and trigger rate of a run that is still being recorded, from a `monitor.py` snapshot.
+    """
+    import matplotlib.pyplot as plt
+    from datetime import datetime
+    from monitor import LiveMonitor
+    with np.load(snapshot_path) as snapshot:
+        for idx, key in enumerate(LiveMonitor.HISTOGRAMS):
+            plt.subplot(3, 2, idx + 1)
+            edges = snapshot[f'{key}_edges']
+            plt.hist(edges[:-1], bins=edges, weights=snapshot[f'{key}_counts'])
+            plt.xlabel(key)
+        plt.subplot(3, 2, 6)
+        if len(snapshot['rate_mean_scaler']):
+            plt.semilogy(snapshot['rate_bin_times']/60, snapshot['rate_mean_scaler'])
+        plt.xlabel("Minutes into run")
+        plt.ylabel("Trigger Rate (Hz)")
+        plt.suptitle(f"{snapshot['source']}: {snapshot['n_events']} events, "
+                     f"updated {datetime.fromtimestamp(float(snapshot['updated'])):%H:%M:%S}")
+    plt.tight_layout()
+
+
 def load_data():
+    """
+    Registers every sample in `d`. Nothing is read here: each figure reads just the branches and entries it needs
+    through `data.SampleData`, which keeps decoded arrays in a byte-bounded cache (`DATA_CACHE_BYTES` per process).
+    """
     from matplotboard import d
-    import uproot
 
     sample_ids, root_file_paths = the_config.find_samples()
     for sample_id, r_file in zip(sample_ids, root_file_paths):
         if sample_id in d:
             print(f"Warning, duplicate sample with id: {sample_id}")
-        d[sample_id] = uproot.open(r_file)['Events']
+        d[sample_id] = sample_data(r_file)
+
+
+def _figure_sample(figure):
+    """
+    The sample a figure is drawn from, or None for figures that combine several samples.
+    """
+    from matplotboard import d
+    sample = figure.args[0] if figure.args else figure.kwargs.get('sample')
+    return sample if isinstance(sample, tuple) and sample in d else None
+
+
+def _render_group(group, n_figures, figure_dir):
+    from matplotboard import d, _render_one
+    if not d:
+        load_data()
+    for idx, name, figure in group:
+        _render_one(idx, n_figures, name, figure, figure_dir, None)
+
+
+def render_by_sample(figures, ncores=None):
+    """
+    Renders `figures` like matplotboard's `render`, but schedules them by sample: all figures drawn from one sample
+    are rendered in the same worker, so each of that sample's branches is read once and then shared through the
+    worker's array cache. Figures that combine several samples are scheduled on their own.
+    """
+    from collections import defaultdict
+    from os.path import join
+    from matplotboard import CONFIG, configure, render
+    from pathos.multiprocessing import Pool
+
+    # Let matplotboard set up the output directory and load `d`, without rendering anything
+    multiprocess = CONFIG['multiprocess']
+    configure(multiprocess=False)
+    render({})
+    configure(multiprocess=multiprocess)
+
+    groups = defaultdict(list)
+    for idx, (name, figure) in enumerate(figures.items()):
+        sample = _figure_sample(figure)
+        groups[sample if sample is not None else ('figure', name)].append((idx, name, figure))
+    groups = sorted(groups.values(), key=len, reverse=True)
+
+    figure_dir = join(CONFIG['output_dir'], 'figures')
+    if multiprocess:
+        with Pool(ncores) as pool:
+            pool.starmap(_render_group, [(group, len(figures), figure_dir) for group in groups])
+    else:
+        for group in groups:
+            _render_group(group, len(figures), figure_dir)
+    render(figures, build=False)
 
 
 def main():
+    from matplotboard import configure, generate_report, serve
     sample_ids, _ = the_config.find_samples()
 
     figures = {}
@@ -212,13 +319,22 @@ def main():
     figures[f'all_width'] = observable_comparison(the_config.all_pmt_ids(), 'width', range_=(0, 500))
     # figures[f'all_scaler'] = observable_comparison(the_config.all_pmt_ids(), 'scaler', )
 
+    # Runs still being recorded by monitor.py. Snapshots older than the processed file are left over from runs that
+    # have since been converted.
+    for snapshot_path in sorted(Path(the_config.PROCESSED_DATA_ROOT).rglob('*.live.npz')):
+        run = snapshot_path.relative_to(the_config.PROCESSED_DATA_ROOT).as_posix()[:-len('.live.npz')]
+        root_file_path = Path(the_config.PROCESSED_DATA_ROOT) / f'{run}.root'
+        if root_file_path.exists() and root_file_path.stat().st_mtime >= snapshot_path.stat().st_mtime:
+            continue
+        figures[f'live-{run.replace("/", "-")}'] = live_monitor(str(snapshot_path))
+
     output_dir = f'PMTAnalysis-{date.today().isoformat()}'
     configure(
         multiprocess=True,
         output_dir=output_dir,
         data_loader=load_data,
     )
-    render(figures, ncores=8)
+    render_by_sample(figures, ncores=8)
     generate_report(figures, 'PMT Results')
 
     try:
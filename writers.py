@@ -0,0 +1,334 @@
+from pathlib import Path
+import os
+import time
+import numpy as np
+
+from atomic import tmp_path
+from config import the_config
+from selection import selected_events
+
+
+def root_compression():
+    """
+    The compression used for ROOT output, from the `COMPRESSION` and `COMPRESSION_LEVEL` config fields.
+    """
+    import uproot
+    name = the_config.COMPRESSION.upper()
+    if name == "NONE":
+        return None
+    if name not in ("ZLIB", "LZMA", "LZ4", "ZSTD"):
+        raise ValueError(f"Unknown compression algorithm \"{the_config.COMPRESSION}\"")
+    return getattr(uproot.compression, name)(the_config.COMPRESSION_LEVEL)
+
+
+def interleave_channels(blocks):
+    """
+    Merges the per-channel arrays of a chunk (one per EventTable, with a row per event) into one array in event-major
+    order: every channel of the first event, then every channel of the next, and so on. The entry of (event k,
+    channel c) within the chunk is then `k*len(blocks) + c`, so chunks written one after another give the same order
+    whatever their size.
+    """
+    if not blocks:
+        return np.array([])
+    return np.stack(blocks, axis=1).reshape(-1, *blocks[0].shape[1:])
+
+
+class EventWriter:
+    """
+    EventWriter: One output format for the processed events of a `DRSDatFile`. A writer is given each chunk of
+    EventTables in event order through `write` and is then finished with `close`. Everything is written under
+    temporary names, and `commit` renames the outputs into place once they are complete (`abort` discards them).
+
+    Writers opened with `partial` set write one part of a checkpointed conversion, and `merge` combines the parts.
+    """
+    suffix = None
+
+    def __init__(self, drs, path, partial=False):
+        self.drs = drs
+        self.path = Path(path)
+        self.partial = partial
+
+    def outputs(self):
+        """
+        The files this writer produces.
+        """
+        return [self.path]
+
+    @classmethod
+    def waveform_encoding(cls):
+        """
+        The encoding of the waveforms this writer writes out ("volts" or "adc"), or None if it writes none.
+        """
+        return None
+
+    def write(self, tables):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def commit(self):
+        for path in self.outputs():
+            os.replace(tmp_path(path), path)
+
+    def abort(self):
+        for path in self.outputs():
+            tmp_path(path).unlink(missing_ok=True)
+
+    @classmethod
+    def merge(cls, drs, part_paths, path, chunk_size):
+        """
+        Combines the outputs of the `partial` writers at `part_paths`, in order, into one output at `path`. Returns
+        the writer, closed but not yet committed.
+        """
+        raise NotImplementedError
+
+
+class RootWriter(EventWriter):
+    """
+    The Events tree, and the Calibration tree unless `partial`, in a ROOT file. This is what the report reads. With
+    `INCLUDE_WAVEFORMS` and `WAVEFORM_SELECTION` set, the selected waveforms go in a Waveforms tree instead of Events.
+    """
+    suffix = ".root"
+
+    def __init__(self, drs, path, partial=False):
+        super().__init__(drs, path, partial)
+        self._file = None
+        self._trees = {}
+        self._n_entries = 0  # entries written to the Events tree
+        self.select_waveforms = the_config.INCLUDE_WAVEFORMS and the_config.WAVEFORM_SELECTION
+
+    @classmethod
+    def waveform_encoding(cls):
+        return the_config.WAVEFORM_ENCODING if the_config.INCLUDE_WAVEFORMS else None
+
+    def _open(self):
+        import uproot
+        with self.drs.stats.stage("write"):
+            self._file = uproot.recreate(tmp_path(self.path), compression=root_compression())
+
+    def write_branches(self, branches, tree='Events'):
+        if self._file is None:
+            self._open()
+        n_events = len(branches['id']) // max(len(self.drs.channels), 1) if tree == 'Events' else 0
+        with self.drs.stats.stage("write", events=n_events, bytes_=sum(branch.nbytes for branch in branches.values())):
+            if tree not in self._trees:
+                self._file[tree] = branches
+                self._trees[tree] = self._file[tree]
+            elif len(branches['id']):
+                self._trees[tree].extend(branches)
+        if tree == 'Events':
+            self._n_entries += len(branches['id'])
+
+    def write(self, tables):
+        entry_start = self._n_entries
+        self.write_branches(self.drs._serialize(tables))
+        if self.select_waveforms:
+            self.write_branches(self.drs._serialize_waveforms(tables, entry_start), 'Waveforms')
+
+    def close(self):
+        if self._file is None:
+            self._open()
+        with self.drs.stats.stage("write"):
+            if 'Events' not in self._trees:
+                self._file['Events'] = self.drs._root_branches([])
+            if self.select_waveforms and 'Waveforms' not in self._trees:
+                self._file['Waveforms'] = self.drs._waveform_branches([], 0)
+            if not self.partial:
+                self._file['Calibration'] = self.drs._calibration_branches()
+            self._file.close()
+
+    @classmethod
+    def merge(cls, drs, part_paths, path, chunk_size):
+        import uproot
+        writer = cls(drs, path)
+        for part_path in part_paths:
+            with uproot.open(part_path) as part_file:
+                entry_start = writer._n_entries
+                for branches in part_file['Events'].iterate(step_size=chunk_size, library='np'):
+                    writer.write_branches(branches)
+                if writer.select_waveforms:
+                    for branches in part_file['Waveforms'].iterate(step_size=chunk_size, library='np'):
+                        branches['entry'] = branches['entry'] + entry_start
+                        writer.write_branches(branches, 'Waveforms')
+        writer.close()
+        return writer
+
+
+class ParquetWriter(EventWriter):
+    """
+    The per-event columns of the Events tree as a Parquet table, one row per (event, channel) in the same order as
+    the Events entries, for pandas and Arrow based analysis. Rows are written in row groups of
+    `PARQUET_ROW_GROUP_SIZE`, so readers can stream the file one row group at a time, and each row holds its entry
+    number ("entry") so that ranges of entries can be read without counting rows. With `PARQUET_WAVEFORMS` set, the
+    waveforms are written to a separate `<name>.waveforms.parquet` along with the entry, id, board and channel of
+    their event, which keeps them out of the way of readers that only want features. With `WAVEFORM_SELECTION` also
+    set, only the waveforms of the selected events are written there, and the feature table gains the "selection"
+    column.
+    """
+    suffix = ".parquet"
+    COLUMNS = ('entry', 'id', 'board', 'channel', 'scaler', 'timestamp', 'range_center', 'polarity',
+               'area', 'width', 'noise', 'peak_t', 'peak_v')
+
+    def __init__(self, drs, path, partial=False):
+        super().__init__(drs, path, partial)
+        self.waveform_path = self.path.with_suffix(".waveforms.parquet")
+        self._writers = {}
+        self._buffers = {path: [] for path in self.outputs()}
+        self._n_rows = 0  # rows of the feature table so far
+
+    def outputs(self):
+        return [self.path, self.waveform_path] if the_config.PARQUET_WAVEFORMS else [self.path]
+
+    @classmethod
+    def waveform_encoding(cls):
+        return the_config.WAVEFORM_ENCODING if the_config.PARQUET_WAVEFORMS else None
+
+    def columns(self):
+        return self.COLUMNS + (('selection',) if the_config.WAVEFORM_SELECTION else ())
+
+    @classmethod
+    def feature_schema(cls):
+        import pyarrow as pa
+        schema = pa.schema([
+            ('entry', pa.int64()), ('id', pa.int64()), ('board', pa.int64()), ('channel', pa.int64()),
+            ('scaler', pa.int64()), ('timestamp', pa.float64()), ('range_center', pa.int64()), ('polarity', pa.int8()),
+            ('area', pa.float64()), ('width', pa.float32()), ('noise', pa.float64()), ('peak_t', pa.float32()),
+            ('peak_v', pa.float64()),
+        ])
+        return schema.append(pa.field('selection', pa.uint8())) if the_config.WAVEFORM_SELECTION else schema
+
+    def schema(self, path):
+        import pyarrow as pa
+        if path == self.waveform_path:
+            sample = pa.uint16() if the_config.WAVEFORM_ENCODING == "adc" else pa.float64()
+            return pa.schema([('entry', pa.int64()), ('id', pa.int64()), ('board', pa.int64()),
+                              ('channel', pa.int64()), ('waveform', pa.list_(sample, self.drs.N_BINS))])
+        return self.feature_schema()
+
+    def _record_batches(self, tables):
+        """
+        The rows of a chunk of EventTables, as a record batch for each output.
+        """
+        import pyarrow as pa
+        columns = {name: [] for name in self.columns() if name != 'entry'}
+        waveforms = []
+        for table in tables.values():
+            for name in columns:
+                if name == 'board':
+                    columns[name].append(np.full(len(table), table.board, dtype=np.int64))
+                elif name == 'channel':
+                    columns[name].append(np.full(len(table), table.channel, dtype=np.int64))
+                else:
+                    columns[name].append(table.columns[name])
+            waveforms.append(table.adc if the_config.WAVEFORM_ENCODING == "adc" else table.waveform)
+
+        columns = {name: interleave_channels(blocks) for name, blocks in columns.items()}
+        columns['entry'] = self._n_rows + np.arange(len(columns['id']))
+        schema = self.schema(self.path)
+        batches = {self.path: pa.RecordBatch.from_arrays(
+            [pa.array(columns[name], type=schema.field(name).type) for name in self.columns()], schema=schema)}
+        if the_config.PARQUET_WAVEFORMS:
+            rows = np.arange(len(batches[self.path]))
+            if the_config.WAVEFORM_SELECTION:
+                kept = selected_events(tables.values())
+                rows = rows[np.repeat(kept, len(tables))]
+                waveforms = [block[kept] for block in waveforms]
+            schema = self.schema(self.waveform_path)
+            samples = pa.array(interleave_channels(waveforms).ravel(), type=schema.field('waveform').type.value_type)
+            waveform = pa.FixedSizeListArray.from_arrays(samples, self.drs.N_BINS)
+            batches[self.waveform_path] = pa.RecordBatch.from_arrays(
+                [batches[self.path].column(name).take(pa.array(rows)) for name in ('entry', 'id', 'board', 'channel')]
+                + [waveform], schema=schema)
+        self._n_rows += len(batches[self.path])
+        return batches
+
+    def _flush(self, path, force=False):
+        """
+        Writes out the buffered rows for `path` as full row groups, keeping any remainder buffered unless `force` is
+        set.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        row_group_size = the_config.PARQUET_ROW_GROUP_SIZE
+        buffer = self._buffers[path]
+        n_rows = sum(len(batch) for batch in buffer)
+        n_write = n_rows if force else n_rows - n_rows % row_group_size
+        if path not in self._writers and (n_write or force):
+            self._writers[path] = pq.ParquetWriter(tmp_path(path), self.schema(path),
+                                                   compression=the_config.PARQUET_COMPRESSION)
+        if not n_write:
+            return
+        table = pa.Table.from_batches(buffer, schema=self.schema(path))
+        with self.drs.stats.stage("write", bytes_=table.slice(0, n_write).nbytes):
+            self._writers[path].write_table(table.slice(0, n_write), row_group_size=row_group_size)
+        buffer[:] = table.slice(n_write).to_batches()
+
+    def write_batch(self, path, batch):
+        self._buffers[path].append(batch)
+        self._flush(path)
+
+    def write(self, tables):
+        if not tables:
+            return
+        with self.drs.stats.stage("serialize", events=len(next(iter(tables.values())))):
+            batches = self._record_batches(tables)
+        for path, batch in batches.items():
+            self.write_batch(path, batch)
+
+    def close(self):
+        for path in self.outputs():
+            self._flush(path, force=True)
+            self._writers.pop(path).close()
+
+    @classmethod
+    def merge(cls, drs, part_paths, path, chunk_size):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        writer = cls(drs, path)
+        for part_path in part_paths:
+            for output, part_output in zip(writer.outputs(), cls(drs, part_path).outputs()):
+                for batch in pq.ParquetFile(part_output).iter_batches(batch_size=the_config.PARQUET_ROW_GROUP_SIZE):
+                    # Entries in a part count from its own first row
+                    entry = pc.add(batch.column('entry'), writer._n_rows)
+                    batch = pa.RecordBatch.from_arrays([entry] + batch.columns[1:], schema=batch.schema)
+                    writer.write_batch(output, batch)
+            writer._n_rows += pq.ParquetFile(part_path).metadata.num_rows
+        writer.close()
+        return writer
+
+
+def commit_all(writers):
+    """
+    Commits `writers`, giving all of their outputs the same modification time. An output can then be told apart from
+    one left behind by an earlier conversion by being older than the others (see `dataset.parquet_path`).
+    """
+    now = time.time_ns()
+    for writer in writers:
+        writer.commit()
+        for path in writer.outputs():
+            os.utime(path, ns=(now, now))
+
+
+WRITERS = {
+    "root": RootWriter,
+    "parquet": ParquetWriter,
+}
+
+
+def writer_types(formats):
+    """
+    The EventWriter class for each of `formats`, which are keys of `WRITERS`.
+    """
+    unknown = [name for name in formats if name.lower() not in WRITERS]
+    if unknown:
+        raise ValueError(f"Unknown output format(s) {unknown}, expected some of {list(WRITERS)}")
+    return [WRITERS[name.lower()] for name in formats]
+
+
+def waveform_encodings(types):
+    """
+    The waveform encodings written by any of the EventWriter classes `types`.
+    """
+    return {writer_type.waveform_encoding() for writer_type in types} - {None}